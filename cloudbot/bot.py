@@ -22,7 +22,9 @@ from cloudbot.hook import Action
 from cloudbot.plugin import PluginManager
 from cloudbot.reloader import PluginReloader, ConfigReloader
 from cloudbot.util import database, formatting, async_util
+from cloudbot.util.executor_pool import ExecutorPool
 from cloudbot.util.mapping import KeyFoldDict
+from cloudbot.util.timers import TimerScheduler
 
 logger = logging.getLogger("cloudbot")
 
@@ -60,19 +62,15 @@ def clean_name(n):
     return re.sub('[^A-Za-z0-9_]+', '', n.replace(" ", "_"))
 
 
-def get_cmd_regex(event):
-    conn = event.conn
-    is_pm = event.chan.lower() == event.nick.lower()
-    command_prefix = re.escape(conn.config.get('command_prefix', '.'))
-    conn_nick = re.escape(event.conn.nick)
+def _build_cmd_regex(command_prefix, conn_nick, is_pm):
     cmd_re = re.compile(
         r"""
         ^
         # Prefix or nick
         (?:
-            (?P<prefix>[""" + command_prefix + r"""])""" + ('?' if is_pm else '') + r"""
+            (?P<prefix>[""" + re.escape(command_prefix) + r"""])""" + ('?' if is_pm else '') + r"""
             |
-            """ + conn_nick + r"""[,;:]+\s+
+            """ + re.escape(conn_nick) + r"""[,;:]+\s+
         )
         (?P<command>\w+)  # Command
         (?:$|\s+)
@@ -83,6 +81,62 @@ def get_cmd_regex(event):
     return cmd_re
 
 
+def get_cmd_regex(event):
+    is_pm = event.chan.lower() == event.nick.lower()
+    command_prefix = event.conn.config.get('command_prefix', '.')
+    return _build_cmd_regex(command_prefix, event.conn.nick, is_pm)
+
+
+class CommandMatcher:
+    """
+    Holds the compiled command regexes for a connection's command prefix and nick
+
+    :type command_prefix: str
+    :type nick: str
+    """
+
+    def __init__(self, command_prefix, nick):
+        self.command_prefix = command_prefix
+        self.nick = nick
+        self.chan_re = _build_cmd_regex(command_prefix, nick, False)
+        self.pm_re = _build_cmd_regex(command_prefix, nick, True)
+
+        # In a channel, a command must start with either a prefix character or the bot's nick
+        self.first_chars = set()
+        for char in command_prefix + nick[:1]:
+            self.first_chars.update((char, char.lower(), char.upper()))
+
+    def match(self, text, is_pm=False):
+        """
+        :type text: str
+        :type is_pm: bool
+        :rtype: re.__Match | None
+        """
+        if is_pm:
+            return self.pm_re.match(text)
+
+        if text[:1] not in self.first_chars:
+            # Ordinary chat line, no need to run the regex
+            return None
+
+        return self.chan_re.match(text)
+
+
+def get_cmd_matcher(conn):
+    """
+    Returns the CommandMatcher for a connection, building it if the connection's nick or config has changed
+
+    :type conn: cloudbot.client.Client
+    :rtype: CommandMatcher
+    """
+    matcher = conn.cmd_matcher
+    if matcher is None:
+        matcher = CommandMatcher(conn.config.get('command_prefix', '.'), conn.nick)
+        conn.cmd_matcher = matcher
+
+    return matcher
+
+
 class CloudBot:
     """
     :type start_time: float
@@ -96,6 +150,7 @@ class CloudBot:
     :type db_factory: sqlalchemy.orm.session.sessionmaker
     :type db_session: sqlalchemy.orm.scoping.scoped_session
     :type db_metadata: sqlalchemy.sql.schema.MetaData
+    :type db_executor_pool: cloudbot.util.executor_pool.ExecutorPool
     :type loop: asyncio.events.AbstractEventLoop
     :type stopped_future: asyncio.Future
     :param: stopped_future: Future that will be given a result when the bot has stopped.
@@ -124,6 +179,9 @@ class CloudBot:
         # for plugins to abuse
         self.memory = collections.defaultdict()
 
+        # one-shot jobs scheduled by plugins
+        self.timers = TimerScheduler(loop=self.loop)
+
         # declare and create data folder
         self.data_dir = os.path.abspath('data')
         if not os.path.exists(self.data_dir):
@@ -151,6 +209,12 @@ class CloudBot:
         self.db_metadata = database.metadata
         self.db_base = declarative_base(metadata=self.db_metadata, bind=self.db_engine)
 
+        # worker threads for coroutine hooks which use the database
+        db_pool_conf = self.config.get("database_pool", {})
+        self.db_executor_pool = ExecutorPool(
+            db_pool_conf.get("max_workers", 8), thread_name_prefix="db-worker-", loop=self.loop
+        )
+
         # set botvars so plugins can access when loading
         database.engine = self.db_engine
         database.base = self.db_base
@@ -190,6 +254,9 @@ class CloudBot:
         logger.debug("Waiting for plugin unload")
         self.loop.run_until_complete(self.plugin_manager.unload_all())
         logger.debug("Unload complete")
+        self.timers.close()
+        self.plugin_manager.executors.shutdown()
+        self.db_executor_pool.shutdown()
         self.loop.close()
         return restart
 
@@ -352,11 +419,12 @@ class CloudBot:
 
         if event.type is EventType.message:
             # Commands
-            cmd_match = get_cmd_regex(event).match(event.content)
+            is_pm = event.chan.lower() == event.nick.lower()
+            cmd_matcher = get_cmd_matcher(event.conn)
+            cmd_match = cmd_matcher.match(event.content, is_pm)
 
             if cmd_match:
-                command_prefix = event.conn.config.get('command_prefix', '.')
-                prefix = cmd_match.group('prefix') or command_prefix[0]
+                prefix = cmd_match.group('prefix') or cmd_matcher.command_prefix[0]
                 command = cmd_match.group('command').lower()
                 text = cmd_match.group('text').strip()
                 cmd_event = partial(
@@ -368,11 +436,7 @@ class CloudBot:
                     add_hook(command_hook, command_event)
                     matched_command = True
                 else:
-                    potential_matches = []
-                    for potential_match, plugin in self.plugin_manager.commands.items():
-                        if potential_match.startswith(command):
-                            potential_matches.append((potential_match, plugin))
-
+                    potential_matches = self.plugin_manager.commands.prefix_items(command)
                     if potential_matches:
                         matched_command = True
                         if len(potential_matches) == 1:
@@ -380,7 +444,7 @@ class CloudBot:
                             command_event = cmd_event(hook=command_hook)
                             add_hook(command_hook, command_event)
                         else:
-                            commands = sorted(command for command, plugin in potential_matches)
+                            commands = [command for command, plugin in potential_matches]
                             txt_list = formatting.get_text_list(commands)
 
                             avoid_notices = event.conn.config.get("avoid_notices", False)
@@ -392,7 +456,7 @@ class CloudBot:
         if event.type in (EventType.message, EventType.action):
             # Regex hooks
             regex_matched = False
-            for regex, regex_hook in self.plugin_manager.regex_hooks:
+            for regex, regex_hook in self.plugin_manager.regex_dispatcher.candidates(event.content):
                 if not regex_hook.run_on_cmd and matched_command:
                     continue
 
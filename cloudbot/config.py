@@ -56,10 +56,15 @@ class Config(OrderedDict):
         self.update(data)
         logger.debug("Config loaded from file.")
 
-        # reload permissions
+        plugin_manager = getattr(self.bot, "plugin_manager", None)
+        if plugin_manager is not None:
+            plugin_manager.reload_config()
+
+        # reload permissions and any config-derived connection state
         if self.bot.connections:
             for connection in self.bot.connections.values():
                 connection.permissions.reload()
+                connection.reload()
 
     def save_config(self):
         """saves the contents of the config dict to the config file"""
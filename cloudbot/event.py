@@ -1,7 +1,7 @@
-import concurrent.futures
 import enum
 import logging
 from functools import partial
+from operator import attrgetter
 
 from irclib.parser import Message
 
@@ -19,6 +19,53 @@ class EventType(enum.Enum):
     other = 6
 
 
+class _EventData:
+    """
+    The parsed line data behind an event, shared between an event and all of its copies
+    """
+
+    __slots__ = (
+        'type', 'content', 'content_raw', 'target', 'chan', 'nick', 'user', 'host', 'mask',
+        'irc_raw', 'irc_prefix', 'irc_command', 'irc_paramlist', 'irc_ctcp_text',
+    )
+
+    def __init__(self, event_type, content, content_raw, target, channel, nick, user, host, mask, irc_raw,
+                 irc_prefix, irc_command, irc_paramlist, irc_ctcp_text):
+        self.type = event_type
+        self.content = content
+        self.content_raw = content_raw
+        self.target = target
+        self.chan = channel
+        self.nick = nick
+        self.user = user
+        self.host = host
+        self.mask = mask
+        self.irc_raw = irc_raw
+        self.irc_prefix = irc_prefix
+        self.irc_command = irc_command
+        self.irc_paramlist = irc_paramlist
+        self.irc_ctcp_text = irc_ctcp_text
+
+    def copy(self):
+        new = _EventData.__new__(_EventData)
+        for name in _EventData.__slots__:
+            setattr(new, name, getattr(self, name))
+
+        return new
+
+
+def _data_attr(name):
+    def _set(self, value):
+        if self._shared_data:
+            # Another event may be reading this data, so give this event its own copy before changing it
+            self._data = self._data.copy()
+            self._shared_data = False
+
+        setattr(self._data, name, value)
+
+    return property(attrgetter('_data.' + name), _set)
+
+
 class Event:
     """
     :type bot: cloudbot.bot.CloudBot
@@ -33,7 +80,7 @@ class Event:
     :type host: str
     :type mask: str
     :type db: sqlalchemy.orm.Session
-    :type db_executor: concurrent.futures.ThreadPoolExecutor
+    :type db_executor: concurrent.futures.ThreadPoolExecutor | None
     :type irc_raw: str
     :type irc_prefix: str
     :type irc_command: str
@@ -41,6 +88,23 @@ class Event:
     :type irc_ctcp_text: str
     """
 
+    __slots__ = ('_data', '_shared_data', 'db', 'db_executor', 'bot', 'conn', 'hook')
+
+    type = _data_attr('type')
+    content = _data_attr('content')
+    content_raw = _data_attr('content_raw')
+    target = _data_attr('target')
+    chan = _data_attr('chan')
+    nick = _data_attr('nick')
+    user = _data_attr('user')
+    host = _data_attr('host')
+    mask = _data_attr('mask')
+    irc_raw = _data_attr('irc_raw')
+    irc_prefix = _data_attr('irc_prefix')
+    irc_command = _data_attr('irc_command')
+    irc_paramlist = _data_attr('irc_paramlist')
+    irc_ctcp_text = _data_attr('irc_ctcp_text')
+
     def __init__(self, *, bot=None, hook=None, conn=None, base_event=None, event_type=EventType.other, content=None,
                  content_raw=None, target=None, channel=None, nick=None, user=None, host=None, mask=None, irc_raw=None,
                  irc_prefix=None, irc_command=None, irc_paramlist=None, irc_ctcp_text=None):
@@ -100,39 +164,17 @@ class Event:
             if self.hook is None and base_event.hook is not None:
                 self.hook = base_event.hook
 
-            # If base_event is provided, don't check these parameters, just inherit
-            self.type = base_event.type
-            self.content = base_event.content
-            self.content_raw = base_event.content_raw
-            self.target = base_event.target
-            self.chan = base_event.chan
-            self.nick = base_event.nick
-            self.user = base_event.user
-            self.host = base_event.host
-            self.mask = base_event.mask
-            # clients-specific parameters
-            self.irc_raw = base_event.irc_raw
-            self.irc_prefix = base_event.irc_prefix
-            self.irc_command = base_event.irc_command
-            self.irc_paramlist = base_event.irc_paramlist
-            self.irc_ctcp_text = base_event.irc_ctcp_text
+            # If base_event is provided, don't check these parameters, just share its data until either event
+            # assigns to one of them
+            self._data = base_event._data
+            self._shared_data = base_event._shared_data = True
         else:
             # Since base_event wasn't provided, we can take these parameters
-            self.type = event_type
-            self.content = content
-            self.content_raw = content_raw
-            self.target = target
-            self.chan = channel
-            self.nick = nick
-            self.user = user
-            self.host = host
-            self.mask = mask
-            # clients-specific parameters
-            self.irc_raw = irc_raw
-            self.irc_prefix = irc_prefix
-            self.irc_command = irc_command
-            self.irc_paramlist = irc_paramlist
-            self.irc_ctcp_text = irc_ctcp_text
+            self._data = _EventData(
+                event_type, content, content_raw, target, channel, nick, user, host, mask, irc_raw, irc_prefix,
+                irc_command, irc_paramlist, irc_ctcp_text
+            )
+            self._shared_data = False
 
     async def prepare(self):
         """
@@ -150,10 +192,14 @@ class Event:
         if "db" in self.hook.required_args:
             # logger.debug("Opening database session for {}:threaded=False".format(self.hook.description))
 
-            # we're running a coroutine hook with a db, so initialise an executor pool
-            self.db_executor = concurrent.futures.ThreadPoolExecutor(1)
-            # be sure to initialize the db in the database executor, so it will be accessible in that thread.
-            self.db = await self.async_call(self.bot.db_session)
+            # we're running a coroutine hook with a db, so lease a database thread for this event
+            self.db_executor = await self.bot.db_executor_pool.lease()
+            try:
+                # be sure to initialize the db in the database executor, so it will be accessible in that thread.
+                self.db = await self.async_call(self.bot.db_session)
+            except BaseException:
+                self._release_db_executor()
+                raise
 
     def prepare_threaded(self):
         """
@@ -188,8 +234,16 @@ class Event:
         if self.db is not None:
             # logger.debug("Closing database session for {}:threaded=False".format(self.hook.description))
             # be sure the close the database in the database executor, as it is only accessable in that one thread
-            await self.async_call(self.db.close)
-            self.db = None
+            try:
+                await self.async_call(self.db.close)
+            finally:
+                self.db = None
+                self._release_db_executor()
+
+    def _release_db_executor(self):
+        if self.db_executor is not None:
+            self.bot.db_executor_pool.release(self.db_executor)
+            self.db_executor = None
 
     def close_threaded(self):
         """
@@ -383,6 +437,15 @@ class Event:
         except AttributeError:
             raise KeyError(item)
 
+    @classmethod
+    def valid_args(cls):
+        """
+        Returns the names a hook receiving this type of event may take as arguments
+
+        :rtype: set[str]
+        """
+        return {name for name in dir(cls) if not name.startswith('_')}
+
 
 class CommandEvent(Event):
     """
@@ -391,6 +454,8 @@ class CommandEvent(Event):
     :type triggered_command: str
     """
 
+    __slots__ = ('text', 'doc', 'triggered_command', 'triggered_prefix')
+
     def __init__(self, *, bot=None, hook, text, triggered_command, cmd_prefix,
                  conn=None, base_event=None, event_type=None, content=None,
                  content_raw=None, target=None, channel=None, nick=None,
@@ -446,6 +511,8 @@ class RegexEvent(Event):
     :type match: re.__Match
     """
 
+    __slots__ = ('match',)
+
     def __init__(self, *, bot=None, hook, match, conn=None, base_event=None,
                  event_type=None, content=None, content_raw=None, target=None,
                  channel=None, nick=None, user=None, host=None, mask=None,
@@ -466,6 +533,8 @@ class RegexEvent(Event):
 
 
 class CapEvent(Event):
+    __slots__ = ('cap', 'cap_param')
+
     def __init__(self, *args, cap, cap_param=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.cap = cap
@@ -473,6 +542,8 @@ class CapEvent(Event):
 
 
 class IrcOutEvent(Event):
+    __slots__ = ('parsed_line',)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.parsed_line = None
@@ -507,6 +578,8 @@ class IrcOutEvent(Event):
 
 
 class PostHookEvent(Event):
+    __slots__ = ('launched_hook', 'launched_event', 'result', 'error')
+
     def __init__(self, *args, launched_hook=None, launched_event=None,
                  result=None, error=None, **kwargs):
         super().__init__(*args, **kwargs)
@@ -16,11 +16,26 @@ from irclib.parser import Message
 from cloudbot.event import Event, EventType, IrcOutEvent
 from cloudbot.permissions import PermissionManager
 from cloudbot.util import async_util
+from cloudbot.util.framing import LineFramer
+from cloudbot.util.line_decoder import LineDecoder, DEFAULT_FALLBACKS
+from cloudbot.util.message_split import pack_targets, split_message
+from cloudbot.util.send_queue import SendQueue, PRIORITY_PROTOCOL, PRIORITY_ADMIN, PRIORITY_REPLY
 
 logger = logging.getLogger("cloudbot")
 
 irc_nick_re = re.compile(r'[A-Za-z0-9^{\}\[\]\-`_|\\]+')
 
+# The longest a line can be, excluding the trailing CRLF
+IRC_LINE_LENGTH = 510
+
+# Messages starting with one of a connection's strip_cmd_chars are prefixed with this, so they can't trigger other bots
+DEFAULT_STRIP_CMD_CHARS = "!.@;$"
+STRIP_CMD_PREFIX = "\x0304[!!]\x0f "
+
+# Used in place of the bot's ident and host when they aren't known, long enough for most servers
+DEFAULT_IDENT_LENGTH = 10
+DEFAULT_HOST_LENGTH = 63
+
 irc_bad_chars = ''.join([chr(x) for x in list(range(0, 1)) + list(range(4, 32)) + list(range(127, 160))])
 irc_clean_re = re.compile('[{}]'.format(re.escape(irc_bad_chars)))
 
@@ -29,6 +44,24 @@ def irc_clean(dirty):
     return irc_clean_re.sub('', dirty)
 
 
+# Outgoing commands which don't default to PRIORITY_REPLY
+irc_command_priorities = {
+    "PONG": PRIORITY_PROTOCOL,
+    "PING": PRIORITY_PROTOCOL,
+    "PASS": PRIORITY_PROTOCOL,
+    "NICK": PRIORITY_PROTOCOL,
+    "USER": PRIORITY_PROTOCOL,
+    "CAP": PRIORITY_PROTOCOL,
+    "AUTHENTICATE": PRIORITY_PROTOCOL,
+    "QUIT": PRIORITY_PROTOCOL,
+    "MODE": PRIORITY_ADMIN,
+    "KICK": PRIORITY_ADMIN,
+    "TOPIC": PRIORITY_ADMIN,
+    "INVITE": PRIORITY_ADMIN,
+    "JOIN": PRIORITY_ADMIN,
+    "PART": PRIORITY_ADMIN,
+}
+
 irc_command_to_event_type = {
     "PRIVMSG": EventType.message,
     "JOIN": EventType.join,
@@ -38,16 +71,35 @@ irc_command_to_event_type = {
 }
 
 
-def decode(bytestring):
+def get_line_command(line):
     """
-    Tries to decode a bytestring using multiple encoding formats
+    Returns the command from a raw IRC line without parsing the rest of it
+    :type line: str
+    :rtype: str | None
     """
-    for codec in ('utf-8', 'iso-8859-1', 'shift_jis', 'cp1252'):
-        try:
-            return bytestring.decode(codec)
-        except UnicodeDecodeError:
-            continue
-    return bytestring.decode('utf-8', errors='ignore')
+    words = line.split(None, 3)
+    index = 0
+    if words and words[0].startswith('@'):
+        # Skip the tags
+        index += 1
+
+    if len(words) > index and words[index].startswith(':'):
+        # Skip the prefix
+        index += 1
+
+    if len(words) > index:
+        return words[index].upper()
+
+    return None
+
+
+def get_line_priority(line):
+    """
+    Picks the send queue lane for a raw outgoing line from its command
+    :type line: str
+    :rtype: int
+    """
+    return irc_command_priorities.get(get_line_command(line), PRIORITY_REPLY)
 
 
 def client(_type):
@@ -89,6 +141,8 @@ class IrcClient():
         self.bot = bot
         self.loop = bot.loop
         self.name = name
+        # built on demand by cloudbot.bot.get_cmd_matcher
+        self.cmd_matcher = None
         self.nick = nick
         self._type = _type
 
@@ -124,6 +178,7 @@ class IrcClient():
         self.use_ssl = conn_config.get('ssl', False)
         self._ignore_cert_errors = conn_config.get('ignore_cert', False)
         self._timeout = conn_config.get('timeout', 300)
+        self.max_recv_line_length = conn_config.get('max_recv_line_length', 16384)
         self.server = conn_config['server']
         self.port = conn_config.get('port', 6667)
 
@@ -144,6 +199,15 @@ class IrcClient():
 
         self._connecting = False
 
+        self.decoder = LineDecoder(
+            self.config.get("encoding", "utf-8"), self.config.get("fallback_encodings", DEFAULT_FALLBACKS)
+        )
+
+        # Each connection gets its own send queue with these limits
+        flood_config = config.get('flood_control', {})
+        self.flood_burst = flood_config.get('burst', 5)
+        self.flood_rate = flood_config.get('rate', 1.0)
+
     def make_ssl_context(self, conn_config):
         if self.use_ssl:
             ssl_context = ssl.create_default_context()
@@ -265,17 +329,139 @@ class IrcClient():
                 self.cmd("QUIT")
 
     def close(self):
-        self.quit()
+        self._active = False
         if self._protocol:
+            if self.connected:
+                # Skip the send queue, anything still in it is dropped along with the connection
+                self._protocol.write_line("QUIT")
+
             self._protocol.close()
 
-    def message(self, target, *messages):
+    @property
+    def send_queue(self):
+        """
+        The send queue of the current connection, None before the first connection
+
+        :rtype: SendQueue | None
+        """
+        return self._protocol and self._protocol.send_queue
+
+    def get_self_mask(self):
+        """
+        Returns the bot's own nick!user@host as other clients will see it, as tracked by chan_track.
+        If the user and host aren't known yet, placeholders as long as the server is likely to allow are used.
+        :rtype: str
+        """
+        ident = host = None
+        users = self.memory.get("users")
+        if users is not None:
+            user = users.get(self.nick)
+            if user is not None:
+                ident = user.ident
+                host = user.host
+
+        return "{}!{}@{}".format(
+            self.nick, ident or "u" * DEFAULT_IDENT_LENGTH, host or "h" * DEFAULT_HOST_LENGTH
+        )
+
+    def split_text(self, command, target, text):
+        """
+        Splits `text` into lines which will fit in a `command` sent to `target`, once the server adds the bot's mask
+        :type command: str
+        :type target: str
+        :type text: str
+        :rtype: list[str]
+        """
+        encoding = self.config.get("encoding", "utf-8")
+        prefix = ":{} {} {} :".format(self.get_self_mask(), command, target)
+        budget = IRC_LINE_LENGTH - len(prefix.encode(encoding, "replace"))
+        return split_message(
+            str(text), budget, encoding=encoding, max_lines=self.config.get("max_reply_lines", 5),
+            escape_chars=self.get_strip_cmd_chars(command), escape_prefix=STRIP_CMD_PREFIX
+        )
+
+    def get_strip_cmd_chars(self, command):
+        """
+        Returns the characters which get STRIP_CMD_PREFIX added by core_out when they start a `command` line
+        :type command: str
+        :rtype: str
+        """
+        if command != "PRIVMSG":
+            return ""
+
+        return self.config.get("strip_cmd_chars", DEFAULT_STRIP_CMD_CHARS)
+
+    def message(self, target, *messages, priority=None):
         for text in messages:
-            self.cmd("PRIVMSG", target, text)
+            for line in self.split_text("PRIVMSG", target, text):
+                self.cmd("PRIVMSG", target, line, priority=priority)
+
+    def get_target_limit(self, command):
+        """
+        Returns the most targets the server allows in one `command`, from its TARGMAX or MAXTARGETS ISUPPORT tokens
+        as tracked by server_info, or None if there is no limit
+        :type command: str
+        :rtype: int | None
+        """
+        server_info = self.memory.get("server_info", {})
+        targmax = server_info.get("targmax")
+        if targmax is not None:
+            # Commands missing from TARGMAX only take a single target
+            return targmax.get(command.upper(), 1)
+
+        if command.upper() in ("PRIVMSG", "NOTICE"):
+            max_targets = server_info.get("isupport_tokens", {}).get("MAXTARGETS")
+            return int(max_targets) if max_targets else 1
+
+        # Any server should accept a list of channels to JOIN
+        return None
+
+    def _cmd_many(self, command, targets, text, priority=None):
+        targets = list(targets)
+        if not targets:
+            return
+
+        encoding = self.config.get("encoding", "utf-8")
+        lines = self.split_text(command, max(targets, key=len), text)
+        strip_chars = self.get_strip_cmd_chars(command)
+        prefix_size = len(STRIP_CMD_PREFIX.encode(encoding, "replace"))
+        longest = max(
+            len(line.encode(encoding, "replace")) + (prefix_size if line and line[0] in strip_chars else 0)
+            for line in lines
+        )
+        # "<command> <targets> :<line>"
+        budget = IRC_LINE_LENGTH - len(command) - 3 - longest
+        batches = pack_targets(
+            targets, budget, max_count=self.get_target_limit(command),
+            size=lambda target: len(target.encode(encoding, "replace"))
+        )
+        for batch in batches:
+            for line in lines:
+                self.cmd(command, ",".join(batch), line, priority=priority)
+
+    def message_many(self, targets, text, priority=None):
+        """
+        Sends `text` to each of `targets`, using as few PRIVMSG lines as the server allows
+        :type targets: list[str]
+        :type text: str
+        :type priority: int | None
+        """
+        self._cmd_many("PRIVMSG", targets, text, priority=priority)
+
+    def notice_many(self, targets, text, priority=None):
+        """
+        Sends `text` to each of `targets`, using as few NOTICE lines as the server allows
+        :type targets: list[str]
+        :type text: str
+        :type priority: int | None
+        """
+        self._cmd_many("NOTICE", targets, text, priority=priority)
 
     def admin_log(self, text, console=True):
         log_chan = self.config.get("log_channel")
-        if log_chan:
+        if isinstance(log_chan, list):
+            self.message_many(log_chan, text)
+        elif log_chan:
             self.message(log_chan, text)
 
         if console:
@@ -284,8 +470,9 @@ class IrcClient():
     def action(self, target, text):
         self.ctcp(target, "ACTION", text)
 
-    def notice(self, target, text):
-        self.cmd("NOTICE", target, text)
+    def notice(self, target, text, priority=None):
+        for line in self.split_text("NOTICE", target, text):
+            self.cmd("NOTICE", target, line, priority=priority)
 
     def set_nick(self, nick):
         self.cmd("NICK", nick)
@@ -295,6 +482,43 @@ class IrcClient():
         if channel not in self.channels:
             self.channels.append(channel)
 
+    def join_many(self, channels):
+        """
+        Joins each of `channels`, packing them into as few JOIN lines as the server allows.
+        Like join(), each channel may be followed by a space and its key.
+        :type channels: list[str]
+        """
+        encoding = self.config.get("encoding", "utf-8")
+        keyed = []
+        unkeyed = []
+        for channel in channels:
+            name, _, key = channel.partition(' ')
+            if key:
+                keyed.append((name, key))
+            else:
+                unkeyed.append((name, None))
+
+            if channel not in self.channels:
+                self.channels.append(channel)
+
+        def size(item):
+            name, key = item
+            if key is None:
+                return len(name.encode(encoding, "replace"))
+
+            # The key's separator in the key list counts too
+            return len(name.encode(encoding, "replace")) + 1 + len(key.encode(encoding, "replace"))
+
+        limit = self.get_target_limit("JOIN")
+        # "JOIN <channels> <keys>"
+        budget = IRC_LINE_LENGTH - len("JOIN  ")
+        # Keys are matched to channels in order, so channels with keys go in batches of their own
+        for batch in pack_targets(keyed, budget, max_count=limit, size=size):
+            self.send("JOIN {} {}".format(",".join(name for name, _ in batch), ",".join(key for _, key in batch)))
+
+        for batch in pack_targets(unkeyed, budget, max_count=limit, size=size):
+            self.send("JOIN {}".format(",".join(name for name, _ in batch)))
+
     def part(self, channel):
         self.cmd("PART", channel)
         if channel in self.channels:
@@ -315,34 +539,73 @@ class IrcClient():
         out = "\x01{} {}\x01".format(ctcp_type, text)
         self.cmd("PRIVMSG", target, out)
 
-    def cmd(self, command, *params):
+    def cmd(self, command, *params, priority=None):
         """
         Sends a raw IRC command of type <command> with params <params>
         :param command: The IRC command to send
         :param params: The params to the IRC command
         :type command: str
         :type params: (str)
+        :type priority: int | None
+        :rtype: asyncio.Future
         """
         params = list(map(str, params))  # turn the tuple of parameters into a list
-        self.send(str(Message(None, None, command, params)))
+        if priority is None:
+            priority = irc_command_priorities.get(command.upper(), PRIORITY_REPLY)
 
-    def send(self, line, log=True):
+        return self.send(str(Message(None, None, command, params)), priority=priority)
+
+    def send(self, line, log=True, priority=None):
         """
-        Sends a raw IRC line
+        Queues a raw IRC line to be sent, subject to flood control
+        :param priority: The send queue lane to use, picked from the line's command if not given
         :type line: str
         :type log: bool
+        :type priority: int | None
+        :return: A future which completes once the line is sent, it may only be awaited from the bot's event loop
+        :rtype: asyncio.Future
         """
         if not self.connected:
             raise ValueError("Client must be connected to irc server to use send")
-        self.loop.call_soon_threadsafe(self._send, line, log)
 
-    def _send(self, line, log=True):
+        if priority is None:
+            priority = get_line_priority(line)
+
+        fut = async_util.create_future(self.loop)
+        # Tie the line to this connection, so it isn't sent on a new one if the bot reconnects before it is queued
+        self.loop.call_soon_threadsafe(self._send, line, log, priority, fut, self._protocol)
+        return fut
+
+    def _send(self, line, log=True, priority=PRIORITY_REPLY, fut=None, protocol=None):
         """
-        Sends a raw IRC line unchecked. Doesn't do connected check, and is *not* threadsafe
+        Queues a raw IRC line unchecked. Doesn't do connected check, and is *not* threadsafe
         :type line: str
         :type log: bool
+        :type priority: int
+        :type fut: asyncio.Future
+        :param protocol: The connection to send the line on, the current one if not given
+        :type protocol: _IrcProtocol
         """
-        async_util.wrap_future(self._protocol.send(line, log=log), loop=self.loop)
+        if protocol is None:
+            protocol = self._protocol
+
+        return protocol.send_queue.put(line, priority, log, fut=fut)
+
+    def reload(self):
+        """
+        Drops any state derived from the connection config, so it will be rebuilt on next use
+        """
+        self.cmd_matcher = None
+
+    @property
+    def nick(self):
+        return self._nick
+
+    @nick.setter
+    def nick(self, value):
+        self._nick = value
+        # The command regexes include the bot's nick, so they need rebuilding
+        self.cmd_matcher = None
 
     @property
     def connected(self):
@@ -369,10 +632,12 @@ class _IrcProtocol(asyncio.Protocol):
     :type loop: asyncio.events.AbstractEventLoop
     :type conn: IrcClient
     :type bot: cloudbot.bot.CloudBot
-    :type _input_buffer: bytes
+    :type _framer: LineFramer
+    :type skipped_lines: int
     :type _connected: bool
     :type _transport: asyncio.transports.Transport
     :type _connected_future: asyncio.Future
+    :type send_queue: SendQueue
     """
 
     def __init__(self, conn):
@@ -384,7 +649,9 @@ class _IrcProtocol(asyncio.Protocol):
         self.conn = conn
 
         # input buffer
-        self._input_buffer = b""
+        self._framer = LineFramer(conn.max_recv_line_length)
+        # Lines skipped as no hook needed them
+        self.skipped_lines = 0
 
         # connected
         self._connected = False
@@ -396,6 +663,9 @@ class _IrcProtocol(asyncio.Protocol):
         # Future that waits until we are connected
         self._connected_future = async_util.create_future(self.loop)
 
+        # Lines waiting to be sent on this connection
+        self.send_queue = SendQueue(self.send, burst=conn.flood_burst, rate=conn.flood_rate, loop=self.loop)
+
     def connection_made(self, transport):
         self._transport = transport
         self._connecting = False
@@ -406,6 +676,8 @@ class _IrcProtocol(asyncio.Protocol):
 
     def connection_lost(self, exc):
         self._connected = False
+        # Anything still queued was meant for this connection
+        self.send_queue.close()
         if exc:
             logger.error("[%s] Connection lost: %s", self.conn.name, exc)
 
@@ -414,6 +686,7 @@ class _IrcProtocol(asyncio.Protocol):
     def close(self):
         self._connecting = False
         self._connected = False
+        self.send_queue.close()
         if self._transport:
             self._transport.close()
 
@@ -434,14 +707,18 @@ class _IrcProtocol(asyncio.Protocol):
                 raise ValueError("Attempted to send data to a closed connection")
 
         old_line = line
-        filtered = bool(self.bot.plugin_manager.out_sieves)
+        plugin_manager = self.bot.plugin_manager
+        filtered = bool(plugin_manager.out_stages)
 
-        for out_sieve in self.bot.plugin_manager.out_sieves:
-            event = IrcOutEvent(
-                bot=self.bot, hook=out_sieve, conn=self.conn, irc_raw=line
-            )
+        for stage in plugin_manager.out_stages:
+            if isinstance(stage, tuple):
+                ok, new_line = plugin_manager.run_inline_out_sieves(stage, self.conn, line)
+            else:
+                event = IrcOutEvent(
+                    bot=self.bot, hook=stage, conn=self.conn, irc_raw=line
+                )
+                ok, new_line = await plugin_manager.internal_launch(stage, event)
 
-            ok, new_line = await self.bot.plugin_manager.internal_launch(out_sieve, event)
             if not ok:
                 logger.warning("Error occurred in outgoing sieve, falling back to old behavior")
                 logger.debug("Line was: %s", line)
@@ -469,12 +746,37 @@ class _IrcProtocol(asyncio.Protocol):
 
         self._transport.write(line)
 
+    def write_line(self, line):
+        """
+        Writes a raw IRC line to the socket straight away, skipping the send queue and outgoing sieves
+
+        :type line: str
+        """
+        line = (line[:510] + "\r\n").encode("utf-8", "replace")
+        logger.debug("[%s|out] >> %r", self.conn.name, line)
+        self._transport.write(line)
+
     def data_received(self, data):
-        self._input_buffer += data
+        overflows = self._framer.overflows
+        lines = self._framer.feed(data)
+        if self._framer.overflows != overflows:
+            logger.warning(
+                "[%s] Discarded %d line(s) longer than %d bytes from %s",
+                self.conn.name, self._framer.overflows - overflows, self._framer.max_line_length,
+                self.conn.describe_server()
+            )
 
-        while b"\r\n" in self._input_buffer:
-            line_data, self._input_buffer = self._input_buffer.split(b"\r\n", 1)
-            line = decode(line_data)
+        interest = self.bot.plugin_manager.irc_interest
+        decoder = self.conn.decoder
+        for line_data in lines:
+            line = decoder.decode(line_data)
+
+            if interest is not None:
+                command = get_line_command(line)
+                if command != "PING" and command not in interest:
+                    # No hooks are interested in this line, don't bother parsing it
+                    self.skipped_lines += 1
+                    continue
 
             try:
                 message = Message.parse(line)
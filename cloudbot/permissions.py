@@ -2,6 +2,9 @@ import logging
 
 from irclib.util.compare import match_mask
 
+from cloudbot.util.lru import LRUCache
+from cloudbot.util.masks import MaskMatcher
+
 logger = logging.getLogger("cloudbot")
 
 # put your hostmask here for magic
@@ -18,6 +21,9 @@ class PermissionManager(object):
     :type perm_users: dict[str, list[str]]
     """
 
+    # How many user masks to remember the groups and permissions of
+    CACHE_SIZE = 1024
+
     def __init__(self, conn):
         """
         :type conn: cloudbot.client.Client
@@ -35,8 +41,21 @@ class PermissionManager(object):
         self.group_users = {}
         self.perm_users = {}
 
+        self._group_matchers = {}
+        # (generation, lowercase user mask) -> (groups, permissions), see _resolve()
+        self._resolved = LRUCache(self.CACHE_SIZE)
+        self._generation = 0
+
         self.reload()
 
+    def invalidate(self):
+        """
+        Forgets the groups and permissions resolved for every user mask
+        """
+        # Bumping the generation first means a lookup that started before this can't cache a stale result
+        self._generation += 1
+        self._resolved.clear()
+
     def reload(self):
         self.group_perms = {}
         self.group_users = {}
@@ -70,6 +89,9 @@ class PermissionManager(object):
                     self.perm_users[perm] = []
                 self.perm_users[perm].extend(users)
 
+        self._group_matchers = {group: MaskMatcher(users) for group, users in self.group_users.items()}
+        self.invalidate()
+
         logger.debug(
             "[%s|permissions] Group permissions: %s",
             self.name, self.group_perms
@@ -83,6 +105,40 @@ class PermissionManager(object):
             self.name, self.perm_users
         )
 
+    def _resolve(self, user_mask):
+        """
+        Returns the groups matching a user mask, in config order, and the permissions they grant
+
+        :type user_mask: str
+        :rtype: (tuple[str], frozenset[str])
+        """
+        user_mask = user_mask.lower()
+        key = (self._generation, user_mask)
+        resolved = self._resolved.get(key)
+        if resolved is None:
+            groups = tuple(
+                group for group, matcher in self._group_matchers.items() if matcher.match(user_mask)
+            )
+            perms = frozenset(perm for group in groups for perm in self.group_perms.get(group, ()))
+            resolved = groups, perms
+            self._resolved.put(key, resolved)
+
+        return resolved
+
+    @property
+    def cache_hits(self):
+        return self._resolved.hits
+
+    @property
+    def cache_misses(self):
+        return self._resolved.misses
+
+    def cache_stats(self):
+        """
+        :rtype: dict[str, int | float]
+        """
+        return self._resolved.stats()
+
     def has_perm_mask(self, user_mask, perm, notice=True):
         """
         :type user_mask: str
@@ -98,16 +154,13 @@ class PermissionManager(object):
             # no one has access
             return False
 
-        allowed_users = self.perm_users[perm.lower()]
-
-        for allowed_mask in allowed_users:
-            if match_mask(user_mask.lower(), allowed_mask):
-                if notice:
-                    logger.info(
-                        "[%s|permissions] Allowed user %s access to %s",
-                        self.name, user_mask, perm
-                    )
-                return True
+        if perm.lower() in self._resolve(user_mask)[1]:
+            if notice:
+                logger.info(
+                    "[%s|permissions] Allowed user %s access to %s",
+                    self.name, user_mask, perm
+                )
+            return True
 
         return False
 
@@ -133,25 +186,14 @@ class PermissionManager(object):
         :type user_mask: str
         :rtype: list[str]
         """
-        permissions = set()
-        for permission, users in self.perm_users.items():
-            for mask_to_check in users:
-                if match_mask(user_mask.lower(), mask_to_check):
-                    permissions.add(permission)
-        return permissions
+        return set(self._resolve(user_mask)[1])
 
     def get_user_groups(self, user_mask):
         """
         :type user_mask: str
         :rtype: list[str]
         """
-        groups = []
-        for group, users in self.group_users.items():
-            for mask_to_check in users:
-                if match_mask(user_mask.lower(), mask_to_check):
-                    groups.append(group)
-                    continue
-        return groups
+        return list(self._resolve(user_mask)[0])
 
     def group_exists(self, group):
         """
@@ -168,13 +210,10 @@ class PermissionManager(object):
         :type user_mask: str
         :rtype: bool
         """
-        users = self.group_users.get(group.lower())
-        if not users:
+        if not self.group_users.get(group.lower()):
             return False
-        for mask_to_check in users:
-            if match_mask(user_mask.lower(), mask_to_check):
-                return True
-        return False
+
+        return group.lower() in self._resolve(user_mask)[0]
 
     def remove_group_user(self, group, user_mask):
         """
@@ -204,6 +243,9 @@ class PermissionManager(object):
                 config_users = config_group.get("users")
                 config_users.remove(mask_to_check)
 
+        if masks_removed:
+            self.invalidate()
+
         return masks_removed
 
     def add_user_to_group(self, user_mask, group):
@@ -229,4 +271,5 @@ class PermissionManager(object):
             group_dict = {"users": [user_mask], "perms": []}
             groups[group] = group_dict
 
+        self.invalidate()
         return True
@@ -4,7 +4,7 @@ import logging
 import sys
 from collections import defaultdict
 from functools import partial
-from itertools import chain
+from itertools import chain, groupby
 from operator import attrgetter
 from pathlib import Path
 from typing import Optional
@@ -12,14 +12,29 @@ from weakref import WeakValueDictionary
 
 import sqlalchemy
 
-from cloudbot.event import Event, PostHookEvent
+from cloudbot.event import Event, EventType, IrcOutEvent, PostHookEvent
+from cloudbot.irc import irc_command_to_event_type
 from cloudbot.plugin_hooks import hook_name_to_plugin
+from cloudbot.scheduler import HookScheduler
 from cloudbot.util import HOOK_ATTR, LOADED_ATTR, async_util, database
-from cloudbot.util.func_utils import call_with_args
+from cloudbot.util.executor_pool import HookExecutors
+from cloudbot.util.mapping import PrefixDict
+from cloudbot.util.regex_dispatch import RegexDispatcher
 
 logger = logging.getLogger("cloudbot")
 
 
+class HookTimeoutError(Exception):
+    """
+    Passed to post hooks as the error of a hook which ran past its deadline
+    """
+
+    def __init__(self, hook, timeout):
+        super().__init__("Hook {} timed out after {} seconds".format(hook.description, timeout))
+        self.hook = hook
+        self.timeout = timeout
+
+
 def find_hooks(parent, module):
     """
     :type parent: Plugin
@@ -73,13 +88,16 @@ class PluginManager:
 
     :type bot: cloudbot.bot.CloudBot
     :type plugins: dict[str, Plugin]
-    :type commands: dict[str, cloudbot.plugin_hooks.CommandHook]
+    :type commands: PrefixDict[str, cloudbot.plugin_hooks.CommandHook]
     :type raw_triggers: dict[str, list[cloudbot.plugin_hooks.RawHook]]
     :type catch_all_triggers: list[cloudbot.plugin_hooks.RawHook]
     :type event_type_hooks: dict[cloudbot.event.EventType,
         list[cloudbot.plugin_hooks.EventHook]]
     :type regex_hooks: list[(re.__Regex, cloudbot.plugin_hooks.RegexHook)]
+    :type regex_dispatcher: RegexDispatcher
     :type sieves: list[cloudbot.plugin_hooks.SieveHook]
+    :type scheduler: cloudbot.scheduler.HookScheduler
+    :type executors: cloudbot.util.executor_pool.HookExecutors
     """
 
     def __init__(self, bot):
@@ -91,17 +109,33 @@ class PluginManager:
 
         self.plugins = {}
         self._plugin_name_map = WeakValueDictionary()
-        self.commands = {}
+        self.commands = PrefixDict()
         self.raw_triggers = {}
         self.catch_all_triggers = []
         self.event_type_hooks = {}
         self.regex_hooks = []
+        self.regex_dispatcher = RegexDispatcher()
         self.sieves = []
         self.cap_hooks = {"on_available": defaultdict(list), "on_ack": defaultdict(list)}
         self.connect_hooks = []
         self.out_sieves = []
+        # out_sieves grouped so runs of inline hooks can be called together, see _build_out_stages()
+        self.out_stages = []
+        # IRC commands which some hook may be triggered by, or None if every line is needed, see _build_interest()
+        self.irc_interest = None
         self.hook_hooks = defaultdict(list)
         self.perm_hooks = defaultdict(list)
+        self.scheduler = HookScheduler.from_config(bot.config.get("hook_scheduler", {}), loop=bot.loop)
+        self.executors = HookExecutors.from_config(bot.config.get("executors", {}))
+        self.hook_timeouts = bot.config.get("hook_timeouts", {})
+
+    def reload_config(self):
+        """
+        Applies the hook limits and timeouts from the bot's config, after it has been reloaded.
+        Executor pools can't be resized while running, so changes to those need a restart.
+        """
+        self.scheduler.reload_config(self.bot.config.get("hook_scheduler", {}))
+        self.hook_timeouts = self.bot.config.get("hook_timeouts", {})
 
     def _add_plugin(self, plugin: 'Plugin'):
         self.plugins[plugin.file_path] = plugin
@@ -237,7 +271,11 @@ class PluginManager:
             return
 
         # create the plugin
-        plugin = Plugin(str(file_path), file_name, title, plugin_module)
+        try:
+            plugin = Plugin(str(file_path), file_name, title, plugin_module)
+        except Exception:
+            logger.exception("Error loading hooks from %s:", title)
+            return
 
         # proceed to register hooks
 
@@ -337,6 +375,7 @@ class PluginManager:
 
         # Sort hooks
         self.regex_hooks.sort(key=lambda x: x[1].priority)
+        self.regex_dispatcher.rebuild(self.regex_hooks)
         dicts_of_lists_of_hooks = (self.event_type_hooks, self.raw_triggers, self.perm_hooks, self.hook_hooks)
         lists_of_hooks = [self.catch_all_triggers, self.sieves, self.connect_hooks, self.out_sieves]
         lists_of_hooks.extend(chain.from_iterable(d.values() for d in dicts_of_lists_of_hooks))
@@ -344,6 +383,9 @@ class PluginManager:
         for lst in lists_of_hooks:
             lst.sort(key=attrgetter("priority"))
 
+        self._build_out_stages()
+        self._build_interest()
+
         # we don't need this anymore
         del plugin.hooks["on_start"]
 
@@ -411,6 +453,8 @@ class PluginManager:
             for regex_match in regex_hook.regexes:
                 self.regex_hooks.remove((regex_match, regex_hook))
 
+        self.regex_dispatcher.rebuild(self.regex_hooks)
+
         # unregister sieves
         for sieve_hook in plugin.hooks["sieve"]:
             self.sieves.remove(sieve_hook)
@@ -422,6 +466,9 @@ class PluginManager:
         for out_hook in plugin.hooks["irc_out"]:
             self.out_sieves.remove(out_hook)
 
+        self._build_out_stages()
+        self._build_interest()
+
         for post_hook in plugin.hooks["post_hook"]:
             self.hook_hooks["post"].remove(post_hook)
 
@@ -453,6 +500,73 @@ class PluginManager:
 
         return True
 
+    def _build_out_stages(self):
+        """
+        Splits out_sieves into stages, each either a single hook to launch normally,
+        or a tuple of consecutive inline hooks to run with run_inline_out_sieves()
+        """
+        stages = []
+        for inline, hooks in groupby(self.out_sieves, key=attrgetter("inline")):
+            if inline:
+                stages.append(tuple(hooks))
+            else:
+                stages.extend(hooks)
+
+        self.out_stages = stages
+
+    def _build_interest(self):
+        """
+        Works out which IRC commands could trigger any loaded hook, so lines with other commands can be skipped
+        without being parsed
+        """
+        if self.catch_all_triggers or EventType.other in self.event_type_hooks:
+            # Something wants to see every line
+            self.irc_interest = None
+            return
+
+        interest = set(self.raw_triggers)
+        event_types = set(self.event_type_hooks)
+        if EventType.action in event_types:
+            # Actions are sent as a CTCP in a PRIVMSG
+            event_types.add(EventType.message)
+
+        interest.update(
+            command for command, event_type in irc_command_to_event_type.items() if event_type in event_types
+        )
+
+        if self.commands or self.regex_hooks:
+            interest.add("PRIVMSG")
+
+        self.irc_interest = frozenset(interest)
+
+    def run_inline_out_sieves(self, hooks, conn, line):
+        """
+        Runs `line` through each of the inline irc_out `hooks` in turn, directly in the event loop
+
+        :type hooks: tuple[cloudbot.plugin_hooks.IrcOutHook]
+        :type conn: cloudbot.client.Client
+        :type line: str | bytes
+        :return: a tuple of (ok, line) where ok is False if one of the hooks errored
+        """
+        for hook in hooks:
+            event = IrcOutEvent(bot=self.bot, hook=hook, conn=conn, irc_raw=line)
+            event.prepare_threaded()
+            try:
+                line = hook.call(event)
+            except Exception:
+                logger.exception("Error in hook %s", hook.description)
+                return False, None
+            finally:
+                event.close_threaded()
+
+            if line is not None and not isinstance(line, bytes):
+                line = str(line)
+
+            if not line:
+                break
+
+        return True, line
+
     def _log_hook(self, hook):
         """
         Logs registering a given hook
@@ -471,7 +585,7 @@ class PluginManager:
         event.prepare_threaded()
 
         try:
-            return call_with_args(hook.function, event)
+            return hook.call(event)
         finally:
             event.close_threaded()
 
@@ -483,10 +597,25 @@ class PluginManager:
         await event.prepare()
 
         try:
-            return await call_with_args(hook.function, event)
+            return await hook.call(event)
         finally:
             await event.close()
 
+    def get_timeout(self, hook):
+        """
+        Returns the number of seconds `hook` may run for, or None if it has no deadline.
+
+        A `timeout` passed to the hook decorator is used first, then the hook type's entry in the
+        "hook_timeouts" config section, then that section's "default".
+
+        :type hook: cloudbot.plugin_hooks.Hook
+        :rtype: float | None
+        """
+        if hook.timeout is not None:
+            return hook.timeout
+
+        return self.hook_timeouts.get(hook.type, self.hook_timeouts.get("default"))
+
     async def internal_launch(self, hook, event):
         """
         Launches a hook with the data from [event]
@@ -496,19 +625,32 @@ class PluginManager:
             is the result from the hook
         """
         if hook.threaded:
-            coro = self.bot.loop.run_in_executor(None, self._execute_hook_threaded, hook, event)
+            coro = self.executors.run(self.bot.loop, hook, self._execute_hook_threaded, hook, event)
         else:
             coro = self._execute_hook_sync(hook, event)
 
         task = async_util.wrap_future(coro)
         hook.plugin.tasks.append(task)
+        timeout = self.get_timeout(hook)
         try:
-            out = await task
+            if timeout is None:
+                out = await task
+            else:
+                # On timeout, coroutine hooks are cancelled, threaded hooks keep running but their result is discarded
+                out = await asyncio.wait_for(task, timeout)
+
             ok = True
         except Exception:
-            logger.exception("Error in hook %s", hook.description)
             ok = False
-            out = sys.exc_info()
+            if timeout is not None and task.cancelled():
+                logger.warning("Hook %s timed out after %s seconds", hook.description, timeout)
+                try:
+                    raise HookTimeoutError(hook, timeout) from None
+                except HookTimeoutError:
+                    out = sys.exc_info()
+            else:
+                logger.exception("Error in hook %s", hook.description)
+                out = sys.exc_info()
 
         hook.plugin.tasks.remove(task)
 
@@ -550,7 +692,7 @@ class PluginManager:
         :rtype: cloudbot.event.Event
         """
         if sieve.threaded:
-            coro = self.bot.loop.run_in_executor(None, sieve.function, self.bot, event, hook)
+            coro = self.executors.run(self.bot.loop, sieve, sieve.function, self.bot, event, hook)
         else:
             coro = sieve.function(self.bot, event, hook)
 
@@ -608,10 +750,44 @@ class PluginManager:
         """
 
         if hook.lock:
+            # Wait for the hook's own lock before taking a slot, so events queued behind a singlethread hook
+            # don't hold slots other hooks could use
             async with hook.lock:
-                return await self._launch(hook, event)
+                return await self._launch_scheduled(hook, event)
+
+        return await self._launch_scheduled(hook, event)
+
+    async def _launch_scheduled(self, hook, event):
+        if not self.scheduler.is_scheduled(hook):
+            return await self._launch(hook, event)
+
+        token = await self.scheduler.acquire(hook, event)
+        if token is None:
+            logger.debug("Hook limits reached, dropping %s", hook.description)
+            return False
+
+        try:
+            return await self._launch(hook, event)
+        finally:
+            self.scheduler.release(token)
+
 
-        return await self._launch(hook, event)
+def create_missing_indexes(table, engine):
+    """
+    Creates any indexes defined on `table` which don't exist in the database yet,
+    for when an index is added to a table which has already been created
+
+    :type table: sqlalchemy.Table
+    :type engine: sqlalchemy.engine.Engine
+    """
+    if not table.indexes:
+        return
+
+    existing = {index['name'] for index in sqlalchemy.inspect(engine).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name not in existing:
+            logger.info("Creating index %s on %s", index.name, table.name)
+            index.create(engine)
 
 
 class Plugin:
@@ -656,6 +832,8 @@ class Plugin:
             for table in self.tables:
                 if not (await bot.loop.run_in_executor(None, table.exists, bot.db_engine)):
                     await bot.loop.run_in_executor(None, table.create, bot.db_engine)
+                else:
+                    await bot.loop.run_in_executor(None, create_missing_indexes, table, bot.db_engine)
 
     def unregister_tables(self, bot):
         """
@@ -2,7 +2,9 @@ import asyncio
 import inspect
 import logging
 
+from cloudbot.event import CapEvent, CommandEvent, Event, IrcOutEvent, PostHookEvent, RegexEvent
 from cloudbot.hook import Action, Priority
+from cloudbot.util.func_utils import ParameterError, call_with_args, make_arg_getter
 
 logger = logging.getLogger("cloudbot")
 
@@ -20,8 +22,14 @@ class Hook:
     :type threaded: bool
     :type permissions: list[str]
     :type single_thread: bool
+    :type timeout: float | None
+    :type event_class: type[Event] | None
     """
 
+    # The type of event this hook's function is called with, or None if it isn't called with its arguments
+    # taken from an event
+    event_class = Event
+
     def __init__(self, _type, plugin, func_hook):
         """
         :type _type: str
@@ -40,6 +48,14 @@ class Hook:
             arg for arg in sig.parameters.keys() if not arg.startswith('_')
         ]
 
+        if self.event_class is not None:
+            valid_args = self.event_class.valid_args()
+            for arg in self.required_args:
+                if arg not in valid_args:
+                    raise ParameterError(arg, sorted(valid_args))
+
+        self.get_args = make_arg_getter(self.required_args)
+
         if asyncio.iscoroutine(self.function) or asyncio.iscoroutinefunction(
             self.function
         ):
@@ -52,6 +68,7 @@ class Hook:
         self.action = func_hook.kwargs.pop("action", Action.CONTINUE)
         self.priority = func_hook.kwargs.pop("priority", Priority.NORMAL)
         self.do_sieve = func_hook.kwargs.pop("do_sieve", True)
+        self.timeout = func_hook.kwargs.pop("timeout", None)
 
         lock = func_hook.kwargs.pop("lock", None)
 
@@ -73,6 +90,20 @@ class Hook:
                 "Ignoring extra args %s from %s", func_hook.kwargs, self.description
             )
 
+    def call(self, event):
+        """
+        Calls this hook's function with its arguments taken from `event`
+
+        :type event: cloudbot.event.Event
+        """
+        try:
+            args = self.get_args(event)
+        except AttributeError:
+            # Let call_with_args raise the proper error for the missing argument
+            return call_with_args(self.function, event)
+
+        return self.function(*args)
+
     @property
     def description(self):
         return "{}:{}".format(self.plugin.title, self.function_name)
@@ -96,6 +127,8 @@ class CommandHook(Hook):
     :type auto_help: bool
     """
 
+    event_class = CommandEvent
+
     def __init__(self, plugin, cmd_hook):
         """
         :type plugin: Plugin
@@ -133,6 +166,8 @@ class RegexHook(Hook):
     :type regexes: set[re.__Regex]
     """
 
+    event_class = RegexEvent
+
     def __init__(self, plugin, regex_hook):
         """
         :type plugin: Plugin
@@ -218,6 +253,9 @@ class RawHook(Hook):
 
 
 class SieveHook(Hook):
+    # Sieves are called as sieve(bot, event, hook)
+    event_class = None
+
     def __init__(self, plugin, sieve_hook):
         """
         :type plugin: Plugin
@@ -284,6 +322,8 @@ class OnStopHook(Hook):
 
 
 class CapHook(Hook):
+    event_class = CapEvent
+
     def __init__(self, _type, plugin, base_hook):
         super().__init__("on_cap_{}".format(_type), plugin, base_hook)
 
@@ -328,9 +368,25 @@ class OnConnectHook(Hook):
 
 
 class IrcOutHook(Hook):
+    """
+    :type inline: bool
+    """
+
+    event_class = IrcOutEvent
+
     def __init__(self, plugin, out_hook):
+        # Inline hooks are called directly from the event loop instead of in a thread pool, so must never block
+        self.inline = out_hook.kwargs.pop("inline", False)
+
         super().__init__("irc_out", plugin, out_hook)
 
+        if self.inline:
+            if not self.threaded:
+                raise ValueError("Inline irc_out hook {} must not be a coroutine".format(self.description))
+
+            if "db" in self.required_args:
+                raise ValueError("Inline irc_out hook {} can not use the database".format(self.description))
+
     def __repr__(self):
         return "Irc_Out[{}]".format(Hook.__repr__(self))
 
@@ -339,6 +395,8 @@ class IrcOutHook(Hook):
 
 
 class PostHookHook(Hook):
+    event_class = PostHookEvent
+
     def __init__(self, plugin, out_hook):
         super().__init__("post_hook", plugin, out_hook)
 
@@ -0,0 +1,296 @@
+import asyncio
+import collections
+import itertools
+import logging
+import time
+from bisect import bisect_left
+
+from cloudbot.util import async_util
+
+logger = logging.getLogger("cloudbot")
+
+QUEUE = "queue"
+DROP = "drop"
+
+# Hook types launched in response to IRC traffic or timers, other types (on_start, on_connect, ...) bypass limits
+SCHEDULED_TYPES = frozenset(("command", "regex", "irc_raw", "event", "periodic"))
+
+
+class WaitHistogram:
+    """
+    Counts wait times in fixed buckets
+
+    :type counts: list[int]
+    :type total: int
+    :type total_time: float
+    """
+
+    BUCKETS = (0.001, 0.01, 0.1, 1, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0
+        self.total_time = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(self.BUCKETS, value)] += 1
+        self.total += 1
+        self.total_time += value
+
+    def as_dict(self):
+        """
+        :rtype: dict[str, int]
+        """
+        out = collections.OrderedDict()
+        for bucket, count in zip(self.BUCKETS, self.counts):
+            out["<={}s".format(bucket)] = count
+
+        out[">{}s".format(self.BUCKETS[-1])] = self.counts[-1]
+        return out
+
+
+class _Limit:
+    __slots__ = ('max', 'in_flight')
+
+    def __init__(self, max_size):
+        self.max = max_size
+        self.in_flight = 0
+
+    def has_capacity(self):
+        return self.max is None or self.in_flight < self.max
+
+
+class HookScheduler:
+    """
+    Limits how many hooks may run at once, globally, per connection and per plugin.
+
+    Hooks which can't start straight away are either queued until a slot frees up, or dropped,
+    depending on the overflow policy for their plugin or hook type.
+
+    :type max_queue: int | None
+    :type overflow: dict[str, str]
+    :type plugin_overflow: dict[str, str]
+    :type dropped: collections.Counter
+    :type wait_times: WaitHistogram
+    """
+
+    def __init__(self, *, loop=None, **limits):
+        """
+        :param limits: The limits to apply, see `configure()`
+        :type loop: asyncio.AbstractEventLoop
+        """
+        self.loop = loop
+
+        self._global = _Limit(None)
+        self._connections = {}
+        self._plugins = {}
+        # Waiting hooks, queued separately for each set of limits they need, so a release only has to look at the
+        # oldest waiter in each queue. {limits: deque[(seq, future)]}
+        self._waiters = {}
+        self._seq = itertools.count()
+        self._queue_length = 0
+
+        self.dropped = collections.Counter()
+        self.wait_times = WaitHistogram()
+
+        self.configure(**limits)
+
+    @staticmethod
+    def _parse_config(conf):
+        return {
+            "max_concurrent": conf.get("max_concurrent"),
+            "max_per_connection": conf.get("max_per_connection"),
+            "max_per_plugin": conf.get("max_per_plugin"),
+            "max_queue": conf.get("max_queue"),
+            "overflow": conf.get("overflow"),
+            "plugin_overflow": conf.get("plugin_overflow"),
+            "plugin_limits": conf.get("plugin_limits"),
+        }
+
+    @classmethod
+    def from_config(cls, conf, loop=None):
+        """
+        :type conf: dict
+        :type loop: asyncio.AbstractEventLoop
+        """
+        return cls(loop=loop, **cls._parse_config(conf))
+
+    def configure(self, *, max_concurrent=None, max_per_connection=None, max_per_plugin=None, max_queue=None,
+                  overflow=None, plugin_overflow=None, plugin_limits=None):
+        """
+        Sets the limits, hooks already running or queued are kept
+
+        :param overflow: The overflow policy for each hook type, with a "default" for the rest
+        :param plugin_overflow: Overflow policies for specific plugins, these override `overflow`
+        :type max_concurrent: int | None
+        :type max_per_connection: int | None
+        :type max_per_plugin: int | None
+        :type max_queue: int | None
+        :type overflow: dict[str, str] | None
+        :type plugin_overflow: dict[str, str] | None
+        :type plugin_limits: dict[str, int] | None
+        """
+        new_overflow = {"default": QUEUE}
+        if overflow:
+            new_overflow.update(overflow)
+
+        new_plugin_overflow = dict(plugin_overflow or {})
+        for policy in itertools.chain(new_overflow.values(), new_plugin_overflow.values()):
+            if policy not in (QUEUE, DROP):
+                raise ValueError("Invalid overflow policy {!r}".format(policy))
+
+        self.overflow = new_overflow
+        self.plugin_overflow = new_plugin_overflow
+        self.max_queue = max_queue
+        self.max_per_connection = max_per_connection
+        self.max_per_plugin = max_per_plugin
+        self.plugin_limits = dict(plugin_limits or {})
+
+        self._global.max = max_concurrent
+        for limit in self._connections.values():
+            limit.max = max_per_connection
+
+        for title, limit in self._plugins.items():
+            limit.max = self.plugin_limits.get(title, max_per_plugin)
+
+        # Some queued hooks may fit under the new limits
+        self._wake()
+
+    def reload_config(self, conf):
+        """
+        :type conf: dict
+        """
+        self.configure(**self._parse_config(conf))
+
+    def is_scheduled(self, hook):
+        return hook.type in SCHEDULED_TYPES
+
+    def _get_limits(self, hook, event):
+        limits = [self._global]
+        if event.conn is not None:
+            try:
+                limit = self._connections[event.conn.name]
+            except LookupError:
+                limit = self._connections[event.conn.name] = _Limit(self.max_per_connection)
+
+            limits.append(limit)
+
+        title = hook.plugin.title
+        try:
+            limit = self._plugins[title]
+        except LookupError:
+            limit = self._plugins[title] = _Limit(self.plugin_limits.get(title, self.max_per_plugin))
+
+        limits.append(limit)
+        return tuple(limits)
+
+    @staticmethod
+    def _take(limits):
+        for limit in limits:
+            limit.in_flight += 1
+
+    async def acquire(self, hook, event):
+        """
+        Waits for a slot to run `hook`.
+
+        Returns a token which must be passed to `release()` once the hook is done,
+        or None if the hook should be dropped.
+
+        :type hook: cloudbot.plugin_hooks.Hook
+        :type event: cloudbot.event.Event
+        """
+        limits = self._get_limits(hook, event)
+        if all(limit.has_capacity() for limit in limits):
+            self._take(limits)
+            self.wait_times.add(0.0)
+            return limits
+
+        policy = self.plugin_overflow.get(hook.plugin.title)
+        if policy is None:
+            policy = self.overflow.get(hook.type, self.overflow["default"])
+
+        if policy == DROP or (self.max_queue is not None and self._queue_length >= self.max_queue):
+            self.dropped[hook.type] += 1
+            return None
+
+        waiter = async_util.create_future(self.loop)
+        try:
+            queue = self._waiters[limits]
+        except LookupError:
+            queue = self._waiters[limits] = collections.deque()
+
+        queue.append((next(self._seq), waiter))
+        self._queue_length += 1
+        start = time.monotonic()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.cancelled():
+                # Left in its queue, it is skipped once it reaches the front
+                self._queue_length -= 1
+            else:
+                # We were given a slot just before being cancelled
+                self.release(limits)
+
+            raise
+
+        self.wait_times.add(time.monotonic() - start)
+        return limits
+
+    def release(self, token):
+        """
+        Frees the slot returned from `acquire()` and starts any queued hooks which now fit
+        """
+        for limit in token:
+            limit.in_flight -= 1
+
+        self._wake()
+
+    def _wake(self):
+        """
+        Starts the longest waiting hooks which now fit, oldest first
+        """
+        while self._waiters and self._global.has_capacity():
+            best = None
+            for limits, queue in list(self._waiters.items()):
+                while queue and queue[0][1].done():
+                    # Cancelled while waiting
+                    queue.popleft()
+
+                if not queue:
+                    del self._waiters[limits]
+                elif (best is None or queue[0][0] < best[1][0][0]) and all(limit.has_capacity() for limit in limits):
+                    best = (limits, queue)
+
+            if best is None:
+                return
+
+            limits, queue = best
+            _, waiter = queue.popleft()
+            if not queue:
+                del self._waiters[limits]
+
+            self._queue_length -= 1
+            self._take(limits)
+            waiter.set_result(None)
+
+    @property
+    def in_flight(self):
+        return self._global.in_flight
+
+    @property
+    def queue_length(self):
+        return self._queue_length
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        return {
+            "in_flight": self.in_flight,
+            "queue_length": self.queue_length,
+            "dropped": dict(self.dropped),
+            "wait_times": self.wait_times.as_dict(),
+            "connections": {name: limit.in_flight for name, limit in self._connections.items()},
+            "plugins": {title: limit.in_flight for title, limit in self._plugins.items() if limit.in_flight},
+        }
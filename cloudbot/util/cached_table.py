@@ -0,0 +1,277 @@
+"""
+An in-memory copy of a database table, for plugins which read a table far more often than they write to it
+
+The table is loaded once, and each write through the cache is applied to the database and then, once committed, to the
+cached rows, so no write needs the whole table to be selected again.
+Rows are nested by their key columns, so `group()` can return every row sharing the first parts of a key.
+"""
+
+import threading
+
+from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import select
+
+__all__ = ('CachedTable',)
+
+_MISSING = object()
+
+
+class CachedTable:
+    """
+    Keys are tuples of the key columns' values, a key with a single column may also be given as just that value.
+    Readers don't take any locks, mappings returned by `group()` are live and should only be iterated with a single
+    call like `list()` or `sorted()`.
+
+    :type table: sqlalchemy.Table
+    :type key_columns: tuple[sqlalchemy.Column]
+    :type value_column: sqlalchemy.Column | None
+    :type loads: int
+    :type writes: int
+    """
+
+    def __init__(self, table, key, value=None):
+        """
+        :param table: The table to cache
+        :param key: The names of the columns which make up each row's key, outermost first
+        :param value: The name of the column to cache for each key, None to only cache the keys
+        :type table: sqlalchemy.Table
+        :type key: tuple[str]
+        :type value: str | None
+        """
+        self.table = table
+        self.key_columns = tuple(table.c[name] for name in key)
+        self._key_names = frozenset(column.name for column in self.key_columns)
+        self.value_column = None if value is None else table.c[value]
+
+        self.loads = 0
+        self.writes = 0
+
+        self._data = {}
+        self._size = 0
+        self._lock = threading.RLock()
+
+    def _make_key(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if len(key) != len(self.key_columns):
+            raise ValueError("Expected a key of {} values, got {!r}".format(len(self.key_columns), key))
+
+        return key
+
+    def _where(self, key):
+        return and_(*(column == value for column, value in zip(self.key_columns, key)))
+
+    def _select_all(self, db):
+        columns = list(self.key_columns)
+        if self.value_column is not None:
+            columns.append(self.value_column)
+
+        data = {}
+        size = 0
+        depth = len(self.key_columns)
+        for row in db.execute(select(columns)):
+            node = data
+            for part in row[:depth - 1]:
+                node = node.setdefault(part, {})
+
+            if row[depth - 1] not in node:
+                size += 1
+
+            node[row[depth - 1]] = row[depth] if self.value_column is not None else None
+
+        return data, size
+
+    def load(self, db):
+        """
+        Replaces the cached rows with the contents of the table
+
+        :type db: sqlalchemy.orm.Session
+        """
+        data, size = self._select_all(db)
+        with self._lock:
+            self._data = data
+            self._size = size
+            self.loads += 1
+
+    def reconcile(self, db):
+        """
+        Reloads the table, for when it may have been changed without going through this cache
+
+        :type db: sqlalchemy.orm.Session
+        :return: The number of keys which were added, removed or changed
+        :rtype: int
+        """
+        with self._lock:
+            old = dict(self.items())
+            self.load(db)
+            new = dict(self.items())
+
+        return sum(1 for key in old.keys() | new.keys() if old.get(key, _MISSING) != new.get(key, _MISSING))
+
+    def _store(self, key, value):
+        node = self._data
+        for part in key[:-1]:
+            node = node.setdefault(part, {})
+
+        if key[-1] not in node:
+            self._size += 1
+
+        node[key[-1]] = value
+
+    def _discard(self, key):
+        nodes = [self._data]
+        for part in key[:-1]:
+            node = nodes[-1].get(part)
+            if node is None:
+                return False
+
+            nodes.append(node)
+
+        if nodes[-1].pop(key[-1], _MISSING) is _MISSING:
+            return False
+
+        self._size -= 1
+        # Remove any groups left empty
+        for parent, part, node in zip(reversed(nodes[:-1]), reversed(key[:-1]), reversed(nodes[1:])):
+            if node:
+                break
+
+            del parent[part]
+
+        return True
+
+    def set(self, db, key, value=None, **columns):
+        """
+        Inserts or updates the row for `key` and commits
+
+        :param value: The value for the value column, ignored if this cache has no value column
+        :param columns: Any other columns to set on the row
+        :return: True if a new row was added
+        :rtype: bool
+        """
+        key = self._make_key(key)
+        values = dict(columns)
+        if self.value_column is not None:
+            values[self.value_column.name] = value
+        else:
+            value = None
+
+        with self._lock:
+            try:
+                if key in self:
+                    if values:
+                        db.execute(self.table.update().where(self._where(key)).values(**values))
+                        db.commit()
+
+                    added = False
+                else:
+                    values.update((column.name, part) for column, part in zip(self.key_columns, key))
+                    db.execute(self.table.insert().values(**values))
+                    db.commit()
+                    added = True
+            except IntegrityError:
+                # The row was added without going through the cache
+                db.rollback()
+                # If only the key columns were given, the existing row already matches and there is nothing to update
+                values = {name: part for name, part in values.items() if name not in self._key_names}
+                if values:
+                    db.execute(self.table.update().where(self._where(key)).values(**values))
+                    db.commit()
+
+                added = False
+            except Exception:
+                db.rollback()
+                raise
+
+            self._store(key, value)
+            self.writes += 1
+
+        return added
+
+    def delete(self, db, key):
+        """
+        Deletes the row for `key` and commits
+
+        :return: True if the row existed
+        :rtype: bool
+        """
+        key = self._make_key(key)
+        with self._lock:
+            try:
+                res = db.execute(self.table.delete().where(self._where(key)))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+
+            found = self._discard(key)
+            self.writes += 1
+
+        return found or res.rowcount > 0
+
+    def get(self, key, default=None):
+        node = self._data
+        key = self._make_key(key)
+        for part in key:
+            node = node.get(part, _MISSING)
+            if node is _MISSING:
+                return default
+
+        return node
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def group(self, *prefix):
+        """
+        Returns a mapping of the last part of each key starting with `prefix` to its value
+
+        :rtype: dict
+        """
+        if len(prefix) != len(self.key_columns) - 1:
+            raise ValueError("Expected a prefix of {} values, got {!r}".format(len(self.key_columns) - 1, prefix))
+
+        node = self._data
+        for part in prefix:
+            node = node.get(part)
+            if node is None:
+                return {}
+
+        return node
+
+    def items(self):
+        """
+        Iterates over each (key, value) pair, this takes a snapshot of the cached rows first
+
+        :rtype: collections.Iterable[(tuple, object)]
+        """
+        with self._lock:
+            pairs = []
+            stack = [((), self._data)]
+            depth = len(self.key_columns)
+            while stack:
+                prefix, node = stack.pop()
+                if len(prefix) == depth - 1:
+                    pairs.extend((prefix + (part,), value) for part, value in node.items())
+                else:
+                    stack.extend((prefix + (part,), child) for part, child in node.items())
+
+        return iter(pairs)
+
+    def keys(self):
+        return (key for key, _ in self.items())
+
+    def __len__(self):
+        return self._size
+
+    def stats(self):
+        """
+        :rtype: dict[str, int]
+        """
+        return {
+            "rows": self._size,
+            "loads": self.loads,
+            "writes": self.writes,
+        }
@@ -0,0 +1,315 @@
+"""
+Thread pools for running hooks and database work
+
+ExecutorPool is a bounded pool of single-threaded executors which can be leased out. Everything submitted to a leased
+executor runs on the same thread, which is needed for objects bound to the thread that created them, like the
+database sessions given to coroutine hooks.
+
+HookExecutors routes threaded hooks to named thread pools.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import time
+from functools import partial
+from itertools import chain
+
+from cloudbot.util import async_util
+
+__all__ = ('ExecutorPool', 'HookExecutors')
+
+
+class ExecutorPool:
+    """
+    :type max_size: int
+    :type thread_name_prefix: str
+    :type lease_count: int
+    :type total_wait: float
+    :type max_wait: float
+    """
+
+    def __init__(self, max_size, *, thread_name_prefix='', loop=None):
+        """
+        :type max_size: int
+        :type thread_name_prefix: str
+        :type loop: asyncio.AbstractEventLoop
+        """
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+
+        self.max_size = max_size
+        self.thread_name_prefix = thread_name_prefix
+        self.loop = loop
+
+        self._executors = []
+        self._idle = []
+        self._waiters = collections.deque()
+
+        # lease statistics
+        self.lease_count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _new_executor(self):
+        executor = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix="{}{}".format(self.thread_name_prefix, len(self._executors))
+        )
+        self._executors.append(executor)
+        return executor
+
+    async def lease(self):
+        """
+        Waits for an executor to become available and returns it.
+        The executor must be given back with `release()` once the caller is done with it.
+
+        :rtype: concurrent.futures.ThreadPoolExecutor
+        """
+        start = time.monotonic()
+        if self._idle:
+            executor = self._idle.pop()
+        elif len(self._executors) < self.max_size:
+            executor = self._new_executor()
+        else:
+            waiter = async_util.create_future(self.loop)
+            self._waiters.append(waiter)
+            try:
+                executor = await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # We were handed an executor just before being cancelled, pass it on
+                    self.release(waiter.result())
+                elif waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+                raise
+
+        wait = time.monotonic() - start
+        self.lease_count += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        return executor
+
+    def release(self, executor):
+        """
+        Returns a leased executor to the pool
+
+        :type executor: concurrent.futures.ThreadPoolExecutor
+        """
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(executor)
+                return
+
+        self._idle.append(executor)
+
+    def shutdown(self, wait=True):
+        """
+        Shuts down every executor in the pool
+        """
+        for executor in self._executors:
+            executor.shutdown(wait=wait)
+
+        self._executors.clear()
+        self._idle.clear()
+
+    @property
+    def size(self):
+        """
+        The number of executors currently started
+        """
+        return len(self._executors)
+
+    @property
+    def in_use(self):
+        return len(self._executors) - len(self._idle)
+
+    @property
+    def queue_depth(self):
+        """
+        The number of callers waiting for an executor
+        """
+        return len(self._waiters)
+
+    @property
+    def average_wait(self):
+        if not self.lease_count:
+            return 0.0
+
+        return self.total_wait / self.lease_count
+
+    def stats(self):
+        """
+        :rtype: dict[str, int | float]
+        """
+        return {
+            'max_size': self.max_size,
+            'size': self.size,
+            'in_use': self.in_use,
+            'queue_depth': self.queue_depth,
+            'leases': self.lease_count,
+            'average_wait': self.average_wait,
+            'max_wait': self.max_wait,
+        }
+
+
+class _PoolStats:
+    __slots__ = ('lock', 'queued', 'active', 'completed', 'busy_time', 'started')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.busy_time = 0.0
+        self.started = time.monotonic()
+
+
+class HookExecutors:
+    """
+    A set of named thread pools which threaded hooks are assigned to, so slow hooks in one pool can't starve the
+    hooks in another.
+
+    A hook is assigned to the first pool found from:
+    - its plugin's entry in `plugins`
+    - its hook type's entry in `hook_types`
+    - the `db` pool, if the hook takes a `db` argument
+    - the `default` pool
+
+    :type plugins: dict[str, str]
+    :type hook_types: dict[str, str]
+    :type default: str
+    """
+
+    DEFAULT_POOLS = {"core": 4, "io": 16, "db": 4}
+    DEFAULT_HOOK_TYPES = {"sieve": "core", "irc_out": "core", "post_hook": "core", "perm_check": "core"}
+
+    def __init__(self, pools=None, *, plugins=None, hook_types=None, default="io"):
+        """
+        :type pools: dict[str, int] | None
+        :type plugins: dict[str, str] | None
+        :type hook_types: dict[str, str] | None
+        :type default: str
+        """
+        if pools is None:
+            pools = self.DEFAULT_POOLS
+
+        if hook_types is None:
+            hook_types = self.DEFAULT_HOOK_TYPES
+
+        self.plugins = dict(plugins or {})
+        self.hook_types = dict(hook_types)
+        self.default = default
+
+        self._executors = {}
+        self._stats = {}
+        for name, workers in pools.items():
+            self._executors[name] = concurrent.futures.ThreadPoolExecutor(
+                workers, thread_name_prefix="{}-worker".format(name)
+            )
+            self._stats[name] = _PoolStats()
+
+        for name in chain((default,), self.plugins.values(), self.hook_types.values()):
+            if name not in self._executors:
+                raise ValueError("Unknown executor pool {!r}".format(name))
+
+    @classmethod
+    def from_config(cls, conf):
+        """
+        :type conf: dict
+        """
+        return cls(
+            conf.get("pools"), plugins=conf.get("plugins"), hook_types=conf.get("hook_types"),
+            default=conf.get("default", "io"),
+        )
+
+    def get_pool_name(self, hook):
+        """
+        :type hook: cloudbot.plugin_hooks.Hook
+        :rtype: str
+        """
+        try:
+            return self.plugins[hook.plugin.title]
+        except LookupError:
+            pass
+
+        try:
+            return self.hook_types[hook.type]
+        except LookupError:
+            pass
+
+        if "db" in hook.required_args and "db" in self._executors:
+            return "db"
+
+        return self.default
+
+    def _wrap(self, stats, func, args):
+        def _run():
+            start = time.monotonic()
+            with stats.lock:
+                stats.queued -= 1
+                stats.active += 1
+
+            try:
+                return func(*args)
+            finally:
+                with stats.lock:
+                    stats.active -= 1
+                    stats.completed += 1
+                    stats.busy_time += time.monotonic() - start
+
+        return _run
+
+    def run(self, loop, hook, func, *args):
+        """
+        Runs `func(*args)` in the pool assigned to `hook`
+
+        :type loop: asyncio.AbstractEventLoop
+        :type hook: cloudbot.plugin_hooks.Hook
+        :rtype: asyncio.Future
+        """
+        name = self.get_pool_name(hook)
+        stats = self._stats[name]
+        with stats.lock:
+            stats.queued += 1
+
+        fut = self._executors[name].submit(self._wrap(stats, func, args))
+        fut.add_done_callback(partial(self._job_done, stats))
+        return asyncio.wrap_future(fut, loop=loop)
+
+    @staticmethod
+    def _job_done(stats, fut):
+        if fut.cancelled():
+            # Cancelled before a worker picked it up (eg. by a hook timeout), so it never left the queue
+            with stats.lock:
+                stats.queued -= 1
+
+    def shutdown(self, wait=True):
+        for executor in self._executors.values():
+            executor.shutdown(wait=wait)
+
+    def stats(self):
+        """
+        Returns, for each pool, its worker count, queued and active jobs, completed jobs,
+        and utilisation (the fraction of worker time spent busy since the pool started)
+
+        :rtype: dict[str, dict[str, int | float]]
+        """
+        now = time.monotonic()
+        out = {}
+        for name, executor in self._executors.items():
+            stats = self._stats[name]
+            workers = executor._max_workers
+            with stats.lock:
+                elapsed = (now - stats.started) * workers
+                out[name] = {
+                    "workers": workers,
+                    "queued": stats.queued,
+                    "active": stats.active,
+                    "completed": stats.completed,
+                    "utilisation": stats.busy_time / elapsed if elapsed else 0.0,
+                }
+
+        return out
@@ -0,0 +1,85 @@
+"""
+Splits a stream of bytes into lines
+"""
+
+__all__ = ('LineFramer',)
+
+
+class LineFramer:
+    """
+    Buffers incoming data and returns each complete line from it.
+
+    Lines may end in either CRLF or a bare LF. Each call to `feed()` only scans the newly received bytes for line
+    endings, and consumed data is dropped from the front of the buffer without copying the remainder.
+
+    :type max_line_length: int | None
+    :type overflows: int
+    """
+
+    def __init__(self, max_line_length=None):
+        """
+        :param max_line_length: The longest partial line to buffer, longer lines are discarded
+        :type max_line_length: int | None
+        """
+        self.max_line_length = max_line_length
+        # Number of over-long lines which have been discarded
+        self.overflows = 0
+
+        self._buffer = bytearray()
+        # Everything in the buffer before this offset is known not to contain a line ending
+        self._scan_pos = 0
+        # Set after an overflow, the rest of the line is skipped up to its line ending
+        self._discarding = False
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def feed(self, data):
+        """
+        Adds `data` to the buffer and returns a list of the complete, non-empty lines now in it,
+        without their line endings
+
+        :type data: bytes
+        :rtype: list[bytes]
+        """
+        buf = self._buffer
+        buf += data
+        lines = []
+        start = 0
+        pos = self._scan_pos
+        with memoryview(buf) as view:
+            while True:
+                idx = buf.find(b"\n", pos)
+                if idx < 0:
+                    break
+
+                end = idx
+                if end > start and buf[end - 1] == 0x0D:  # \r
+                    end -= 1
+
+                if self._discarding:
+                    self._discarding = False
+                elif self.max_line_length is not None and end - start > self.max_line_length:
+                    self.overflows += 1
+                elif end > start:
+                    lines.append(view[start:end].tobytes())
+
+                start = pos = idx + 1
+
+        if start:
+            # bytearray removes data from its front in O(1)
+            del buf[:start]
+
+        # A trailing \r may be the start of the line ending, which doesn't count towards the line's length
+        if self.max_line_length is not None and len(buf) > self.max_line_length + buf.endswith(b"\r"):
+            self.overflows += 1
+            self._discarding = True
+            buf.clear()
+
+        self._scan_pos = len(buf)
+        return lines
+
+    def clear(self):
+        self._buffer.clear()
+        self._scan_pos = 0
+        self._discarding = False
@@ -1,4 +1,5 @@
 import inspect
+from operator import attrgetter
 
 
 class ParameterError(Exception):
@@ -20,3 +21,19 @@ def call_with_args(func, arg_data):
         raise ParameterError(e.args[0], arg_data.keys()) from e
 
     return func(*args)
+
+
+def make_arg_getter(arg_names):
+    """
+    Builds a function which collects the attributes named in `arg_names` from an object, returning them as a tuple
+
+    :type arg_names: list[str]
+    """
+    if not arg_names:
+        return lambda obj: ()
+
+    if len(arg_names) == 1:
+        getter = attrgetter(arg_names[0])
+        return lambda obj: (getter(obj),)
+
+    return attrgetter(*arg_names)
@@ -0,0 +1,190 @@
+"""
+Decodes incoming IRC lines whose encoding isn't known
+
+Lines are tried against the connection's configured encoding first, then any encoding already seen to work for the
+line's sender, then the encoding most often needed on the network, then a list of fallbacks.
+Senders are only tracked once more than one fallback encoding has been needed on the network.
+"""
+
+import codecs
+import collections
+import re
+
+__all__ = ('LineDecoder',)
+
+# iso-8859-1 can decode any byte, so it should always be last
+DEFAULT_FALLBACKS = ('cp1252', 'iso-8859-1')
+
+# Matches the nick in a line's prefix, after any tags
+SENDER_RE = re.compile(rb'(?:@\S* +)?:([^!@ ]+)')
+
+REPLACEMENT_CHAR = '\ufffd'
+
+# cp1252 only differs from iso-8859-1 in these bytes, and iso-8859-1 is much faster to decode
+CP1252_ONLY_BYTES = bytes(range(0x80, 0xa0))
+
+
+def _decode(data, codec):
+    if codec == 'cp1252' and len(data.translate(None, CP1252_ONLY_BYTES)) == len(data):
+        return data.decode('iso-8859-1')
+
+    return data.decode(codec)
+
+
+def get_sender(data):
+    """
+    Returns the nick from the prefix of a raw line, or None if it has no prefix
+
+    :type data: bytes
+    :rtype: bytes | None
+    """
+    match = SENDER_RE.match(data)
+    if match is None:
+        return None
+
+    return match.group(1)
+
+
+class LineDecoder:
+    """
+    :type encoding: str
+    :type fallbacks: tuple[str]
+    :type max_senders: int
+    :type ascii_lines: int
+    :type non_ascii_lines: int
+    :type fallback_lines: int
+    :type failed_lines: int
+    :type codec_counts: dict[str, int]
+    :type dominant: str | None
+    """
+
+    def __init__(self, encoding='utf-8', fallbacks=DEFAULT_FALLBACKS, *, max_senders=1000):
+        """
+        :param encoding: The encoding to try first
+        :param fallbacks: The encodings to try, in order, when a line isn't valid in `encoding`
+        :param max_senders: How many senders to remember the encoding of
+        :type encoding: str
+        :type fallbacks: tuple[str] | list[str]
+        :type max_senders: int
+        """
+        self.encoding = encoding = codecs.lookup(encoding).name
+        self.fallbacks = tuple(
+            codec for codec in (codecs.lookup(name).name for name in fallbacks) if codec != encoding
+        )
+        self.max_senders = max_senders
+
+        # The last fallback encoding which worked for each sender, most recently used last
+        self._senders = collections.OrderedDict()
+
+        try:
+            self._replacement = REPLACEMENT_CHAR.encode(encoding)
+        except UnicodeEncodeError:
+            self._replacement = None
+
+        self.ascii_lines = 0
+        self.non_ascii_lines = 0
+        self.fallback_lines = 0
+        self.failed_lines = 0
+        # Number of lines decoded with each fallback encoding
+        self.codec_counts = {}
+        # The fallback encoding most lines have needed
+        self.dominant = None
+
+    def _remember(self, sender, codec):
+        counts = self.codec_counts
+        count = counts[codec] = counts.get(codec, 0) + 1
+        if codec != self.dominant and (self.dominant is None or count > counts[self.dominant]):
+            self.dominant = codec
+
+        if sender is None:
+            return
+
+        senders = self._senders
+        if senders.get(sender) != codec:
+            senders[sender] = codec
+            if len(senders) > self.max_senders:
+                senders.popitem(last=False)
+
+        senders.move_to_end(sender)
+
+    def _decode_fallback(self, data):
+        if len(self.codec_counts) > 1:
+            # More than one fallback has been needed on this network, so look up what worked for this sender
+            sender = get_sender(data)
+            first = self._senders.get(sender)
+        else:
+            sender = first = None
+
+        if first is not None:
+            try:
+                text = _decode(data, first)
+            except UnicodeDecodeError:
+                pass
+            else:
+                self._remember(sender, first)
+                return text
+
+        dominant = self.dominant
+        for codec in ((dominant,) + self.fallbacks if dominant is not None else self.fallbacks):
+            if codec == first:
+                continue
+
+            try:
+                text = _decode(data, codec)
+            except UnicodeDecodeError:
+                continue
+
+            if sender is None and len(self.codec_counts) > 1:
+                sender = get_sender(data)
+
+            self._remember(sender, codec)
+            return text
+
+        return None
+
+    def decode(self, data):
+        """
+        :type data: bytes
+        :rtype: str
+        """
+        if data.isascii():
+            self.ascii_lines += 1
+            return data.decode('ascii')
+
+        self.non_ascii_lines += 1
+
+        # Decoding with replacement and checking for replacement characters avoids raising an exception
+        # for every line which isn't in the configured encoding
+        text = data.decode(self.encoding, errors='replace')
+        if REPLACEMENT_CHAR not in text:
+            return text
+
+        if self._replacement is not None and self._replacement in data:
+            # The replacement character may have been in the line already
+            try:
+                return data.decode(self.encoding)
+            except UnicodeDecodeError:
+                pass
+
+        self.fallback_lines += 1
+        text = self._decode_fallback(data)
+        if text is None:
+            self.failed_lines += 1
+            text = data.decode(self.encoding, errors='replace')
+
+        return text
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        return {
+            "encoding": self.encoding,
+            "lines": self.ascii_lines + self.non_ascii_lines,
+            "ascii": self.ascii_lines,
+            "fallback": self.fallback_lines,
+            "failed": self.failed_lines,
+            "codecs": dict(self.codec_counts),
+            "dominant": self.dominant,
+            "senders": len(self._senders),
+        }
@@ -0,0 +1,88 @@
+"""
+A bounded, threadsafe cache which evicts its least recently used entries
+"""
+
+import collections
+import threading
+
+__all__ = ('LRUCache',)
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    :type maxsize: int
+    :type hits: int
+    :type misses: int
+    """
+
+    def __init__(self, maxsize=1024):
+        """
+        :param maxsize: The most entries to keep
+        :type maxsize: int
+        """
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for `key`, or `default` if there isn't one.
+        Each call counts as a hit or a miss.
+        """
+        with self._lock:
+            value = self._data.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes every entry, the hit and miss counts are kept
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+
+        return self.hits / total
+
+    def stats(self):
+        """
+        :rtype: dict[str, int | float]
+        """
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+        }
@@ -3,6 +3,7 @@ from collections import defaultdict
 __all__ = (
     'KeyFoldDict',
     'KeyFoldMixin',
+    'PrefixDict',
 )
 
 
@@ -69,3 +70,137 @@ class DefaultKeyFoldDict(KeyFoldMixin, defaultdict):
     """
     KeyFolded defaultdict
     """
+
+
+class _TrieNode:
+    __slots__ = ('children', 'key', 'count')
+
+    def __init__(self):
+        self.children = {}
+        # The full key stored at this node, or None if no key ends here
+        self.key = None
+        # Number of keys stored in this node's subtree
+        self.count = 0
+
+
+class PrefixDict(dict):
+    """
+    A dict with str keys which also maintains a prefix trie of its keys,
+    allowing abbreviation lookups in O(len(prefix)) rather than a scan of every key
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self._root = _TrieNode()
+        self.update(*args, **kwargs)
+
+    def _find_node(self, prefix):
+        node = self._root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return None
+
+        return node
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            node = self._root
+            node.count += 1
+            for char in key:
+                node = node.children.setdefault(char, _TrieNode())
+                node.count += 1
+
+            node.key = key
+
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+
+        node = self._root
+        node.count -= 1
+        for char in key:
+            child = node.children[char]
+            child.count -= 1
+            if not child.count:
+                # Nothing else lives under this branch, drop it entirely
+                del node.children[char]
+                return
+
+            node = child
+
+        node.key = None
+
+    def pop(self, key, *args):
+        """
+        Wraps `dict.pop`
+        """
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+
+        return super().pop(key, *args)
+
+    def popitem(self):
+        """
+        Wraps `dict.popitem`
+        """
+        key, value = super().popitem()
+        super().__setitem__(key, value)
+        del self[key]
+        return key, value
+
+    def setdefault(self, key, default=None):
+        """
+        Wraps `dict.setdefault`
+        """
+        if key not in self:
+            self[key] = default
+
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        """
+        Wraps `dict.update`
+        """
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def clear(self):
+        """
+        Wraps `dict.clear`
+        """
+        super().clear()
+        self._root = _TrieNode()
+
+    def count_prefix(self, prefix):
+        """
+        Returns the number of keys starting with `prefix`
+        """
+        node = self._find_node(prefix)
+        if node is None:
+            return 0
+
+        return node.count
+
+    def prefix_items(self, prefix):
+        """
+        Returns a list of (key, value) pairs for every key starting with `prefix`, sorted by key
+        """
+        node = self._find_node(prefix)
+        if node is None:
+            return []
+
+        out = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.key is not None:
+                out.append((node.key, self[node.key]))
+
+            # Push in reverse order so the smallest child is visited first
+            stack.extend(node.children[c] for c in sorted(node.children, reverse=True))
+
+        return out
@@ -0,0 +1,87 @@
+"""
+Matches hostmasks against sets of banmask style patterns (eg. '*!*@host')
+
+Patterns without wildcards are kept in a set and the rest are combined into one regex,
+so checking a mask against any number of patterns is a hash lookup and at most one regex match.
+The results are the same as checking each pattern with `irclib.util.compare.match_mask`.
+"""
+
+import re
+
+__all__ = ('MaskMatcher', 'is_wildcard', 'glob_to_regex')
+
+GLOB_MAP = {
+    '?': '.',
+    '*': '.*',
+}
+
+
+def is_wildcard(pattern):
+    """
+    :type pattern: str
+    :rtype: bool
+    """
+    return '*' in pattern or '?' in pattern
+
+
+def glob_to_regex(pattern):
+    """
+    Returns the regex source matching the same masks as `pattern`
+
+    :type pattern: str
+    :rtype: str
+    """
+    return ''.join(GLOB_MAP.get(c) or re.escape(c) for c in pattern)
+
+
+class MaskMatcher:
+    """
+    An immutable set of mask patterns
+
+    :type exact: frozenset[str]
+    :type wildcards: tuple[str]
+    """
+
+    __slots__ = ('exact', 'wildcards', '_regex')
+
+    def __init__(self, patterns=()):
+        """
+        :param patterns: The patterns to match against, already lowercased or casefolded to match the masks checked
+        :type patterns: collections.Iterable[str]
+        """
+        exact = set()
+        wildcards = set()
+        for pattern in patterns:
+            if is_wildcard(pattern):
+                wildcards.add(pattern)
+            else:
+                exact.add(pattern)
+
+        self.exact = frozenset(exact)
+        self.wildcards = tuple(sorted(wildcards))
+        if self.wildcards:
+            self._regex = re.compile('|'.join(map(glob_to_regex, self.wildcards)))
+        else:
+            self._regex = None
+
+    def match(self, mask):
+        """
+        Returns whether `mask` is matched by any of the patterns
+
+        :type mask: str
+        :rtype: bool
+        """
+        if mask in self.exact:
+            return True
+
+        return self._regex is not None and self._regex.fullmatch(mask) is not None
+
+    def __len__(self):
+        return len(self.exact) + len(self.wildcards)
+
+    def __bool__(self):
+        return bool(self.exact or self.wildcards)
+
+    def __iter__(self):
+        yield from self.exact
+        yield from self.wildcards
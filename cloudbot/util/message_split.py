@@ -0,0 +1,219 @@
+"""
+Splits long messages into lines which fit in an IRC line
+
+Splits are made on the byte length of the encoded text, preferring to split between words.
+Formatting codes are kept balanced, each line is closed with a reset if any formatting is still active,
+and the next line reopens it.
+"""
+
+import re
+
+__all__ = ('split_message', 'pack_targets', 'FORMAT_CODE_RE')
+
+BOLD = "\x02"
+COLOR = "\x03"
+MONOSPACE = "\x11"
+RESET = "\x0f"
+REVERSE = "\x16"
+ITALIC = "\x1d"
+STRIKETHROUGH = "\x1e"
+UNDERLINE = "\x1f"
+
+TOGGLES = frozenset((BOLD, MONOSPACE, REVERSE, ITALIC, STRIKETHROUGH, UNDERLINE))
+
+FORMAT_CODE_RE = re.compile(r"\x03(?:\d{1,2}(?:,\d{1,2})?)?|[\x02\x0f\x11\x16\x1d\x1e\x1f]")
+
+
+class _FormatState:
+    """
+    The formatting active at some point in a message
+    """
+
+    __slots__ = ('toggles', 'color')
+
+    def __init__(self, toggles=frozenset(), color=None):
+        self.toggles = toggles
+        self.color = color
+
+    def apply(self, code):
+        """
+        :type code: str
+        :rtype: _FormatState
+        """
+        if code == RESET:
+            return _EMPTY_STATE
+
+        if code in TOGGLES:
+            return _FormatState(self.toggles ^ {code}, self.color)
+
+        if len(code) == 1:
+            # A bare \x03 clears the color
+            return _FormatState(self.toggles, None)
+
+        # Pad the color numbers, so reopening the color can't run into digits at the start of the next line
+        color = COLOR + ','.join(num.zfill(2) for num in code[1:].split(','))
+        return _FormatState(self.toggles, color)
+
+    def codes(self):
+        """
+        The formatting codes needed to start a line with this state
+        """
+        return (self.color or '') + ''.join(sorted(self.toggles))
+
+    def __bool__(self):
+        return bool(self.toggles or self.color)
+
+
+_EMPTY_STATE = _FormatState()
+
+
+def _tokenize(text):
+    """
+    Splits text into formatting codes and single characters
+
+    :rtype: list[(str, bool)]
+    """
+    tokens = []
+    pos = 0
+    for match in FORMAT_CODE_RE.finditer(text):
+        tokens.extend((char, False) for char in text[pos:match.start()])
+        tokens.append((match.group(), True))
+        pos = match.end()
+
+    tokens.extend((char, False) for char in text[pos:])
+    return tokens
+
+
+def split_message(text, max_bytes, *, encoding='utf-8', max_lines=None, ellipsis='...', escape_chars='',
+                  escape_prefix=''):
+    """
+    Splits `text` into lines each at most `max_bytes` long once encoded
+
+    :param max_lines: The most lines to return, if the text needs more the last line ends with `ellipsis`
+    :param escape_chars: Lines starting with one of these characters have `escape_prefix` added to them later,
+                         so room is kept for it
+    :type text: str
+    :type max_bytes: int
+    :type encoding: str
+    :type max_lines: int | None
+    :type ellipsis: str
+    :type escape_chars: str
+    :type escape_prefix: str
+    :rtype: list[str]
+    """
+    escape_cost = len(escape_prefix.encode(encoding, 'replace'))
+
+    def needs_escape(line_start):
+        return bool(line_start) and line_start[0] in escape_chars
+
+    extra = escape_cost if needs_escape(text) else 0
+    if len(text) * 4 + extra <= max_bytes or len(text.encode(encoding, 'replace')) + extra <= max_bytes:
+        # Short enough that no splitting is needed
+        return [text]
+
+    tokens = _tokenize(text)
+    costs = [
+        1 if len(token) == 1 and token < '\x80' else len(token.encode(encoding, 'replace'))
+        for token, _ in tokens
+    ]
+    # Keep room to close any open formatting with a reset
+    reserve = 1 if any(is_code for _, is_code in tokens) else 0
+    count = len(tokens)
+
+    def take(pos, state, budget):
+        prefix = state.codes()
+        used = len(prefix.encode(encoding, 'replace')) + reserve
+        if needs_escape(prefix or tokens[pos][0]):
+            used += escape_cost
+
+        out = [prefix]
+        end = pos
+        last_space = None
+        while end < count:
+            token, is_code = tokens[end]
+            if used + costs[end] > budget and end > pos:
+                break
+
+            if token == ' ' and end > pos:
+                last_space = (end, len(out), state)
+
+            out.append(token)
+            used += costs[end]
+            if is_code:
+                state = state.apply(token)
+
+            end += 1
+
+        if end < count and last_space is not None and tokens[end][0] != ' ':
+            # Don't split in the middle of a word
+            end, size, state = last_space
+            del out[size:]
+
+        if end < count:
+            # Drop any spaces left before the split, including those followed only by formatting codes
+            i = len(out) - 1
+            while i > 0 and (out[i] == ' ' or FORMAT_CODE_RE.fullmatch(out[i])):
+                if out[i] == ' ':
+                    del out[i]
+
+                i -= 1
+
+        return out, end, state
+
+    lines = []
+    pos = 0
+    state = _EMPTY_STATE
+    while pos < count:
+        if lines:
+            # Drop the space a line was split on
+            while pos < count and tokens[pos][0] == ' ':
+                pos += 1
+
+            if pos >= count:
+                break
+
+        out, end, new_state = take(pos, state, max_bytes)
+        if max_lines is not None and len(lines) + 1 >= max_lines and end < count:
+            out, end, new_state = take(pos, state, max_bytes - len(ellipsis.encode(encoding, 'replace')))
+            out.append(ellipsis)
+            end = count
+
+        if new_state:
+            out.append(RESET)
+
+        lines.append(''.join(out))
+        pos = end
+        state = new_state
+
+    return lines
+
+
+def pack_targets(targets, max_bytes, *, max_count=None, size=len):
+    """
+    Groups `targets` into batches to be sent as comma-separated lists, each at most `max_count` targets
+    and `max_bytes` long once joined
+
+    :param size: Returns the length a target adds to the list, not counting the separator
+    :type targets: list
+    :type max_bytes: int
+    :type max_count: int | None
+    :rtype: list[list]
+    """
+    batches = []
+    batch = []
+    used = 0
+    for target in targets:
+        cost = size(target) + (1 if batch else 0)
+        if batch and (used + cost > max_bytes or (max_count is not None and len(batch) >= max_count)):
+            batches.append(batch)
+            batch = []
+            used = 0
+            cost -= 1
+
+        batch.append(target)
+        used += cost
+
+    if batch:
+        batches.append(batch)
+
+    return batches
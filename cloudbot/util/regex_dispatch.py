@@ -0,0 +1,163 @@
+"""
+Prefiltered dispatch of regex hooks
+
+Most regex hooks can only match a line containing some fixed text, eg. "http" for URL matchers or "++" for karma.
+These literals are extracted from each pattern when the dispatcher is built, and each distinct literal is searched
+for once per line, so only the regexes which could possibly match are actually run.
+"""
+
+import re
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+__all__ = ('RegexDispatcher', 'required_literals')
+
+_REPEATS = {sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT}
+if hasattr(sre_constants, 'POSSESSIVE_REPEAT'):
+    _REPEATS.add(sre_constants.POSSESSIVE_REPEAT)
+
+
+def _fold(text):
+    # casefold() alone misses the dotless i, which IGNORECASE patterns treat as an i
+    return text.casefold().replace('\u0131', 'i')
+
+
+def _best(requirements):
+    """
+    Picks the most selective requirement, the one whose shortest alternative is longest
+    """
+    if not requirements:
+        return None
+
+    return max(requirements, key=lambda req: min(len(lit) for lit in req))
+
+
+def _find_requirements(items):
+    """
+    Finds every set of literals of which at least one must appear in any text matched by `items`
+
+    :type items: sre_parse.SubPattern
+    :rtype: list[frozenset[str]]
+    """
+    requirements = []
+    run = []
+
+    def flush():
+        if run:
+            requirements.append(frozenset([''.join(run)]))
+            run.clear()
+
+    def walk(_items):
+        for op, av in _items:
+            if op is sre_constants.LITERAL:
+                run.append(chr(av))
+            elif op is sre_constants.AT:
+                # Anchors are zero-width, they don't break up a run of literals
+                continue
+            elif op is sre_constants.SUBPATTERN:
+                add_flags, del_flags = av[1], av[2]
+                if (add_flags | del_flags) & re.IGNORECASE:
+                    # Scoped case-sensitivity changes, don't try to reason about them
+                    flush()
+                else:
+                    walk(av[-1])
+            elif op in _REPEATS and av[0] >= 1:
+                flush()
+                inner = _best(_find_requirements(av[2]))
+                if inner:
+                    requirements.append(inner)
+            elif op is sre_constants.BRANCH:
+                flush()
+                options = [_best(_find_requirements(branch)) for branch in av[1]]
+                if all(options):
+                    requirements.append(frozenset().union(*options))
+            else:
+                flush()
+
+    walk(items)
+    flush()
+    return requirements
+
+
+def required_literals(regex):
+    """
+    Returns a set of literals, one of which must appear in any string `regex` matches,
+    or None if no such set could be determined
+
+    :type regex: re.__Regex
+    :rtype: frozenset[str] | None
+    """
+    pattern = getattr(regex, 'pattern', None)
+    if not isinstance(pattern, str):
+        return None
+
+    try:
+        parsed = sre_parse.parse(pattern, regex.flags)
+    except Exception:
+        return None
+
+    ignorecase = bool(parsed.state.flags & re.IGNORECASE)
+    best = _best(_find_requirements(parsed))
+    if best is None:
+        return None
+
+    if ignorecase:
+        best = frozenset(_fold(lit).replace('i\u0307', 'i') for lit in best)
+
+    return best
+
+
+class RegexDispatcher:
+    """
+    Selects the (regex, hook) pairs which may match a line, preserving their original order
+
+    :type _entries: list[(re.__Regex, cloudbot.plugin_hooks.RegexHook, frozenset[(str, bool)] | None)]
+    :type _literals: set[(str, bool)]
+    """
+
+    def __init__(self, regex_hooks=()):
+        self._entries = []
+        self._literals = set()
+        self._has_ignorecase = False
+        self.rebuild(regex_hooks)
+
+    def rebuild(self, regex_hooks):
+        """
+        :type regex_hooks: list[(re.__Regex, cloudbot.plugin_hooks.RegexHook)]
+        """
+        entries = []
+        literals = set()
+        for regex, hook in regex_hooks:
+            literal_set = required_literals(regex)
+            if literal_set is None:
+                requirement = None
+            else:
+                ignorecase = bool(regex.flags & re.IGNORECASE)
+                requirement = frozenset((lit, ignorecase) for lit in literal_set)
+                literals.update(requirement)
+
+            entries.append((regex, hook, requirement))
+
+        self._entries = entries
+        self._literals = literals
+        self._has_ignorecase = any(ignorecase for _, ignorecase in literals)
+
+    def candidates(self, text):
+        """
+        Yields each (regex, hook) pair which could match `text`
+
+        :type text: str
+        """
+        folded = _fold(text) if self._has_ignorecase else None
+        found = {
+            key for key in self._literals
+            if key[0] in (folded if key[1] else text)
+        }
+
+        for regex, hook, requirement in self._entries:
+            if requirement is None or not found.isdisjoint(requirement):
+                yield regex, hook
@@ -0,0 +1,198 @@
+"""
+Rate limited, prioritised sending of outgoing lines
+
+Lines are queued in one of several lanes and sent in priority order, as fast as a token bucket allows.
+Each queued line gets a future which completes once the line has been written.
+"""
+
+import asyncio
+import collections
+import time
+
+from cloudbot.util import async_util
+from cloudbot.util.tokenbucket import TokenBucket
+
+__all__ = (
+    'SendQueue', 'PRIORITY_PROTOCOL', 'PRIORITY_ADMIN', 'PRIORITY_REPLY', 'PRIORITY_BULK', 'PRIORITY_NAMES',
+)
+
+# PONG and other replies the server expects
+PRIORITY_PROTOCOL = 0
+# Admin and moderation actions, eg. MODE and KICK
+PRIORITY_ADMIN = 1
+# Normal replies to users
+PRIORITY_REPLY = 2
+# Large or non-urgent output, eg. a list of messages
+PRIORITY_BULK = 3
+
+PRIORITY_NAMES = ("protocol", "admin", "reply", "bulk")
+
+
+class SendQueue:
+    """
+    :type burst: int
+    :type rate: float | None
+    :type sent: int
+    :type dropped: int
+    """
+
+    # How many seconds of sends the drain rate is averaged over
+    RATE_WINDOW = 60
+
+    def __init__(self, send, *, burst=5, rate=1.0, loop=None):
+        """
+        :param send: The coroutine function called to actually send each line, as `send(line, log)`
+        :param burst: How many lines can be sent at once before being limited
+        :param rate: How many lines can be sent per second once the burst is used up, None for no limit
+        :type burst: int
+        :type rate: float | None
+        :type loop: asyncio.AbstractEventLoop
+        """
+        if rate is not None and rate <= 0:
+            raise ValueError("rate must be positive")
+
+        self._send = send
+        self.burst = burst
+        self.rate = rate
+        self.loop = loop
+
+        self._bucket = TokenBucket(burst, rate) if rate is not None else None
+        self._lanes = tuple(collections.deque() for _ in PRIORITY_NAMES)
+        self._drain_task = None
+        self.closed = False
+
+        self.sent = 0
+        self.dropped = 0
+        self._send_times = collections.deque()
+
+    def put(self, line, priority=PRIORITY_REPLY, log=True, *, fut=None):
+        """
+        Queues a line to be sent, this is *not* threadsafe
+
+        :type line: str
+        :type priority: int
+        :type log: bool
+        :param fut: The future to complete once the line is sent, a new one is created if not given
+        :type fut: asyncio.Future | None
+        :return: A future which completes once the line has been sent
+        :rtype: asyncio.Future
+        """
+        if fut is None:
+            fut = async_util.create_future(self.loop)
+
+        if self.closed:
+            fut.cancel()
+            self.dropped += 1
+            return fut
+
+        self._lanes[priority].append((line, log, fut))
+        if self._drain_task is None or self._drain_task.done():
+            self._drain_task = async_util.wrap_future(self._drain(), loop=self.loop)
+
+        return fut
+
+    def _next(self):
+        for lane in self._lanes:
+            while lane:
+                item = lane.popleft()
+                if not item[2].done():
+                    return item
+
+        return None
+
+    def _has_pending(self):
+        return any(self._lanes)
+
+    async def _wait_for_token(self):
+        if self._bucket is None:
+            return
+
+        while not self._bucket.consume(1):
+            await asyncio.sleep((1 - self._bucket.tokens) / self._bucket.fill_rate)
+
+    async def _drain(self):
+        while self._has_pending():
+            # Wait for a token before choosing a line, so anything more urgent queued in the meantime goes first
+            await self._wait_for_token()
+            item = self._next()
+            if item is None:
+                return
+
+            line, log, fut = item
+            try:
+                await self._send(line, log)
+            except Exception as e:
+                # Most lines are never awaited, so report the error here rather than leave it unretrieved
+                fut.set_exception(e)
+                fut.exception()
+                (self.loop or asyncio.get_event_loop()).call_exception_handler({
+                    "message": "Error sending line {!r}".format(line),
+                    "exception": e,
+                })
+            else:
+                fut.set_result(None)
+
+            self.sent += 1
+            self._record_send()
+
+    def _record_send(self):
+        now = time.monotonic()
+        self._send_times.append(now)
+        cutoff = now - self.RATE_WINDOW
+        while self._send_times[0] < cutoff:
+            self._send_times.popleft()
+
+    def clear(self):
+        """
+        Drops every queued line, cancelling their futures
+        """
+        for lane in self._lanes:
+            while lane:
+                line, log, fut = lane.popleft()
+                if not fut.done():
+                    fut.cancel()
+                    self.dropped += 1
+
+    def close(self):
+        """
+        Drops every queued line, and any line queued afterwards
+        """
+        self.closed = True
+        self.clear()
+        if self._drain_task is not None:
+            self._drain_task.cancel()
+            self._drain_task = None
+
+    def __len__(self):
+        return sum(len(lane) for lane in self._lanes)
+
+    @property
+    def depths(self):
+        """
+        The number of lines waiting in each lane
+
+        :rtype: dict[str, int]
+        """
+        return {name: len(lane) for name, lane in zip(PRIORITY_NAMES, self._lanes)}
+
+    @property
+    def drain_rate(self):
+        """
+        The average number of lines sent per second over the last `RATE_WINDOW` seconds
+        """
+        cutoff = time.monotonic() - self.RATE_WINDOW
+        return sum(1 for sent_at in self._send_times if sent_at >= cutoff) / self.RATE_WINDOW
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        return {
+            "depth": len(self),
+            "lanes": self.depths,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "drain_rate": self.drain_rate,
+            "burst": self.burst,
+            "rate": self.rate,
+        }
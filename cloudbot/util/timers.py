@@ -0,0 +1,266 @@
+"""
+Runs one-shot jobs at set times
+
+Pending jobs are kept in a min-heap ordered by when they are due, and a single `loop.call_at` is armed for the
+earliest one, so nothing is polled and each job runs as soon as it is due.
+
+Jobs only live in memory. To keep a job across restarts, a plugin stores it in its own table and schedules it again
+from its on_start hook, giving each job a `key` so scheduling it twice replaces the first one.
+"""
+
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from functools import partial
+
+from cloudbot.util import async_util
+
+__all__ = ('TimerScheduler', 'Timer')
+
+
+class Timer:
+    """
+    A scheduled job, returned by `TimerScheduler.schedule()`
+
+    :type when: float
+    :type key: object
+    :type cancelled: bool
+    """
+
+    __slots__ = ('when', 'seq', 'callback', 'args', 'key', 'cancelled')
+
+    def __init__(self, when, seq, callback, args, key):
+        self.when = when
+        self.seq = seq
+        self.callback = callback
+        self.args = args
+        self.key = key
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+    def __repr__(self):
+        return "{}(when={!r}, callback={!r}, key={!r}, cancelled={!r})".format(
+            type(self).__name__, self.when, self.callback, self.key, self.cancelled
+        )
+
+
+class TimerScheduler:
+    """
+    :type fired: int
+    :type cancelled: int
+    :type max_lateness: float
+    """
+
+    # The longest to sleep before checking the clock again, so jobs still run on time if the wall clock jumps
+    MAX_SLEEP = 60
+
+    def __init__(self, *, loop=None):
+        """
+        :type loop: asyncio.AbstractEventLoop
+        """
+        self.loop = loop
+
+        self._heap = []
+        self._keys = {}
+        self._seq = itertools.count()
+        # Cancelled timers are left in the heap until they reach the top, or the heap is compacted
+        self._dead = 0
+        self._handle = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self.fired = 0
+        self.cancelled = 0
+        # The latest any job has run after it was due, in seconds
+        self.max_lateness = 0.0
+
+    def schedule(self, when, callback, *args, key=None):
+        """
+        Runs `callback(*args)` at `when`, this is threadsafe.
+        Coroutine functions are run as tasks on the event loop, and must not block.
+        Any other callable is run in the loop's default executor, so it may block (eg. on the database or HTTP).
+
+        :param when: A Unix timestamp, or a datetime
+        :param key: Identifies the job, scheduling another job with the same key cancels this one
+        :type when: float | datetime.datetime
+        :rtype: Timer
+        """
+        if self._closed:
+            raise RuntimeError("The scheduler has been closed")
+
+        if not isinstance(when, (int, float)):
+            when = when.timestamp()
+
+        timer = Timer(when, next(self._seq), callback, args, key)
+        with self._lock:
+            if key is not None:
+                old = self._keys.get(key)
+                if old is not None:
+                    self._cancel(old)
+
+                self._keys[key] = timer
+
+            heapq.heappush(self._heap, timer)
+            is_first = self._heap[0] is timer
+
+        if is_first:
+            # Re-arm from the loop's thread, as this may be called from a hook's thread
+            self.loop.call_soon_threadsafe(self._arm)
+
+        return timer
+
+    def call_later(self, delay, callback, *args, key=None):
+        """
+        Runs `callback(*args)` in `delay` seconds, see `schedule()`
+
+        :type delay: float
+        :rtype: Timer
+        """
+        return self.schedule(time.time() + delay, callback, *args, key=key)
+
+    def _cancel(self, timer):
+        if timer.cancelled:
+            return False
+
+        timer.cancelled = True
+        self.cancelled += 1
+        self._dead += 1
+        if timer.key is not None and self._keys.get(timer.key) is timer:
+            del self._keys[timer.key]
+
+        if self._dead > 64 and self._dead > len(self._heap) // 2:
+            self._heap = [item for item in self._heap if not item.cancelled]
+            heapq.heapify(self._heap)
+            self._dead = 0
+
+        return True
+
+    def cancel(self, timer):
+        """
+        :type timer: Timer
+        :return: False if the timer had already run or been cancelled
+        :rtype: bool
+        """
+        with self._lock:
+            return self._cancel(timer)
+
+    def cancel_key(self, key):
+        """
+        Cancels the job scheduled with `key`, if there is one
+
+        :rtype: bool
+        """
+        with self._lock:
+            timer = self._keys.get(key)
+            return timer is not None and self._cancel(timer)
+
+    def get(self, key):
+        """
+        :rtype: Timer | None
+        """
+        return self._keys.get(key)
+
+    def _arm(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+        if self._closed:
+            return
+
+        with self._lock:
+            while self._heap and self._heap[0].cancelled:
+                heapq.heappop(self._heap)
+                self._dead -= 1
+
+            if not self._heap:
+                return
+
+            delay = min(self._heap[0].when - time.time(), self.MAX_SLEEP)
+
+        self._handle = self.loop.call_at(self.loop.time() + max(delay, 0), self._run)
+
+    def _run(self):
+        self._handle = None
+        now = time.time()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0].when <= now:
+                timer = heapq.heappop(self._heap)
+                if timer.cancelled:
+                    self._dead -= 1
+                    continue
+
+                # Mark it so it can't be cancelled once it has run
+                timer.cancelled = True
+                if timer.key is not None and self._keys.get(timer.key) is timer:
+                    del self._keys[timer.key]
+
+                due.append(timer)
+
+        for timer in due:
+            self.fired += 1
+            self.max_lateness = max(self.max_lateness, now - timer.when)
+            self._fire(timer)
+
+        self._arm()
+
+    def _report(self, message, exc):
+        self.loop.call_exception_handler({"message": message, "exception": exc})
+
+    def _check_job(self, timer, fut):
+        if not fut.cancelled() and fut.exception() is not None:
+            self._report("Exception in scheduled job {!r}".format(timer), fut.exception())
+
+    def _fire(self, timer):
+        if asyncio.iscoroutinefunction(timer.callback):
+            try:
+                fut = async_util.wrap_future(timer.callback(*timer.args), loop=self.loop)
+            except Exception as e:
+                self._report("Exception in scheduled job {!r}".format(timer), e)
+                return
+        else:
+            # Keep blocking jobs off the event loop
+            fut = self.loop.run_in_executor(None, partial(timer.callback, *timer.args))
+
+        fut.add_done_callback(partial(self._check_job, timer))
+
+    def close(self):
+        """
+        Cancels every pending job
+        """
+        self._closed = True
+        with self._lock:
+            for timer in self._heap:
+                timer.cancelled = True
+
+            self._heap.clear()
+            self._keys.clear()
+            self._dead = 0
+
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def __len__(self):
+        return len(self._heap) - self._dead
+
+    def stats(self):
+        """
+        :rtype: dict[str, int | float | None]
+        """
+        with self._lock:
+            pending = [timer for timer in self._heap if not timer.cancelled]
+            next_due = min(pending).when - time.time() if pending else None
+
+        return {
+            "pending": len(pending),
+            "fired": self.fired,
+            "cancelled": self.cancelled,
+            "next_due": next_due,
+            "max_lateness": self.max_lateness,
+        }
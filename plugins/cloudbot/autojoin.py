@@ -1,14 +1,10 @@
 import asyncio
 
-from collections import defaultdict
-from copy import copy
-from threading import RLock
-
 from sqlalchemy import Column, String
-from sqlalchemy.exc import IntegrityError
 
 from cloudbot import hook
 from cloudbot.util import database
+from cloudbot.util.cached_table import CachedTable
 
 
 class autojoins(database.base):
@@ -24,8 +20,7 @@ class autojoins(database.base):
 
 
 database.metadata.create_all(database.engine)
-chan_cache = defaultdict(set)
-db_lock = RLock()
+chan_cache = CachedTable(autojoins.__table__, ('conn', 'chan'))
 
 
 def get_channels(db, conn):
@@ -36,13 +31,15 @@ def get_channels(db, conn):
 
 @hook.on_start
 def load_cache(db):
-    new_cache = defaultdict(set)
-    for row in db.query(autojoins).all():
-        new_cache[row.conn].add(row.chan)
+    chan_cache.load(db)
+
 
-    with db_lock:
-        chan_cache.clear()
-        chan_cache.update(new_cache)
+@hook.periodic(3600, initial_interval=3600)
+def reconcile_cache(db):
+    """
+    Picks up any changes made to the table while the bot is running
+    """
+    chan_cache.reconcile(db)
 
 
 @hook.irc_raw('376')
@@ -50,43 +47,21 @@ async def do_joins(conn):
     while not conn.ready:
         await asyncio.sleep(1)
 
-    join_throttle = conn.config.get("join_throttle", 0.4)
-    for chan in copy(chan_cache[conn.name]):
-        conn.join(chan)
-        await asyncio.sleep(join_throttle)
+    conn.join_many(list(chan_cache.group(conn.name.casefold())))
 
 
 @hook.irc_raw('JOIN', singlethread=True)
 def add_chan(db, conn, chan, nick):
-    chans = chan_cache[conn.name]
-    chan = chan.casefold()
-    if nick.casefold() == conn.nick.casefold() and chan not in chans:
-        with db_lock:
-            try:
-                autojoin = autojoins(conn.name.casefold(), chan.casefold())
-                db.add(autojoin)
-            except IntegrityError:
-                db.rollback()
-            else:
-                db.commit()
-
-    load_cache(db)
+    key = (conn.name.casefold(), chan.casefold())
+    if nick.casefold() == conn.nick.casefold() and key not in chan_cache:
+        chan_cache.set(db, key)
 
 
 @hook.irc_raw('PART', singlethread=True)
 def on_part(db, conn, chan, nick):
-    if nick.casefold() == conn.nick.casefold():
-        with db_lock:
-            autojoin = db.query(autojoins) \
-                .filter(autojoins.conn == conn.name.casefold()) \
-                .fimter(autojoins.chan == chan.casefold()) \
-                .first()
-
-        if autojoin:
-            db.add(autojoin)
-            db.commit()
-
-    load_cache(db)
+    key = (conn.name.casefold(), chan.casefold())
+    if nick.casefold() == conn.nick.casefold() and key in chan_cache:
+        chan_cache.delete(db, key)
 
 
 @hook.irc_raw('KICK', singlethread=True)
@@ -120,12 +120,9 @@ async def do_joins(conn):
 
     chans = copy(conn.config_channels)
 
-    # Join config-defined channels
-    join_throttle = conn.config.get('join_throttle', 0.4)
+    # Join config-defined channels, the send queue handles flood control
     logger.info("[%s|misc] Bot is joining channels for network.", conn.name)
-    for channel in chans:
-        conn.join(channel)
-        await asyncio.sleep(join_throttle)
+    conn.join_many(chans)
 
 
 @hook.irc_raw('004')
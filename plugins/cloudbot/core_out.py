@@ -4,7 +4,7 @@ Core filters for IRC raw lines
 
 from cloudbot import hook
 from cloudbot.hook import Priority
-from cloudbot.util import colors
+from cloudbot.irc import DEFAULT_STRIP_CMD_CHARS, STRIP_CMD_PREFIX
 
 NEW_LINE_TRANS_TBL = str.maketrans({
     '\r': None,
@@ -13,7 +13,7 @@ NEW_LINE_TRANS_TBL = str.maketrans({
 })
 
 
-@hook.irc_out(priority=Priority.HIGHEST)
+@hook.irc_out(priority=Priority.HIGHEST, inline=True)
 def strip_newlines(line, conn):
     """
     Removes newline characters from a message
@@ -28,13 +28,20 @@ def strip_newlines(line, conn):
     return line
 
 
-@hook.irc_out(priority=Priority.HIGH)
+@hook.irc_out(priority=Priority.HIGH, inline=True)
 def truncate_line(line, conn):
     line_len = conn.config.get("max_line_length", 510)
-    return line[:line_len] + "\r\n"
+    if len(line) * 4 > line_len:
+        # The limit is in bytes, make sure we don't cut a multi-byte character in half
+        encoding = conn.config.get("encoding", "utf-8")
+        data = line.encode(encoding, conn.config.get("encoding_errors", "replace"))
+        if len(data) > line_len:
+            line = data[:line_len].decode(encoding, "ignore")
 
+    return line + "\r\n"
 
-@hook.irc_out(priority=Priority.LOWEST)
+
+@hook.irc_out(priority=Priority.LOWEST, inline=True)
 def encode_line(line, conn):
     if not isinstance(line, str):
         return line
@@ -44,11 +51,11 @@ def encode_line(line, conn):
     return line.encode(encoding, errors)
 
 
-@hook.irc_out(priority=Priority.HIGH)
+@hook.irc_out(priority=Priority.HIGH, inline=True)
 def strip_command_chars(parsed_line, conn, line):
-    chars = conn.config.get("strip_cmd_chars", "!.@;$")
+    chars = conn.config.get("strip_cmd_chars", DEFAULT_STRIP_CMD_CHARS)
     if chars and parsed_line and parsed_line.command == "PRIVMSG" and parsed_line.parameters[-1][0] in chars:
-        new_msg = colors.parse("$(red)[!!]$(clear) ") + parsed_line.parameters[-1]
+        new_msg = STRIP_CMD_PREFIX + parsed_line.parameters[-1]
         parsed_line.parameters[-1] = new_msg
         parsed_line.has_trail = True
         return parsed_line
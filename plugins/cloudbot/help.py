@@ -13,9 +13,7 @@ def get_potential_commands(bot, cmd_name):
     try:
         yield cmd_name, bot.plugin_manager.commands[cmd_name]
     except LookupError:
-        for name, _hook in bot.plugin_manager.commands.items():
-            if name.startswith(cmd_name):
-                yield name, _hook
+        yield from bot.plugin_manager.commands.prefix_items(cmd_name)
 
 
 @hook.command("help", autohelp=False)
@@ -9,12 +9,13 @@ from collections import defaultdict
 
 from cloudbot import hook
 from cloudbot.hook import Priority
+from cloudbot.plugin import HookTimeoutError
 from cloudbot.util import web
 from cloudbot.util.formatting import gen_markdown_table
 
 
 def default_hook_counter():
-    return {'success': 0, 'failure': 0}
+    return {'success': 0, 'failure': 0, 'timeout': 0}
 
 
 def hook_sorter(n):
@@ -41,7 +42,13 @@ def get_stats(bot):
 def stats_sieve(launched_event, error, bot, launched_hook):
     chan = launched_event.chan
     conn = launched_event.conn
-    status = 'success' if error is None else 'failure'
+    if error is None:
+        status = 'success'
+    elif issubclass(error[0], HookTimeoutError):
+        status = 'timeout'
+    else:
+        status = 'failure'
+
     stats = get_stats(bot)
     name = launched_hook.plugin.title + '.' + launched_hook.function_name
     stats['global'][name][status] += 1
@@ -54,10 +61,10 @@ def stats_sieve(launched_event, error, bot, launched_hook):
 
 def do_basic_stats(data):
     table = [
-        (hook_name, str(count['success']), str(count['failure']))
+        (hook_name, str(count['success']), str(count['failure']), str(count['timeout']))
         for hook_name, count in sorted(data.items(), key=hook_sorter(1), reverse=True)
     ]
-    return ("Hook", "Uses - Success", "Uses - Errored"), table
+    return ("Hook", "Uses - Success", "Uses - Errored", "Uses - Timed out"), table
 
 
 def do_global_stats(data):
@@ -76,9 +83,9 @@ def do_hook_stats(data, hook_name):
     table = [
         (net, chan, hooks[hook_name]) for net, chans in data['channel'].items() for chan, hooks in chans.items()
     ]
-    return ("Network", "Channel", "Uses - Success", "Uses - Errored"), \
+    return ("Network", "Channel", "Uses - Success", "Uses - Errored", "Uses - Timed out"), \
            [
-               (net, chan, str(count['success']), str(count['failure']))
+               (net, chan, str(count['success']), str(count['failure']), str(count['timeout']))
                for net, chan, count in sorted(table, key=hook_sorter(2), reverse=True)
            ]
 
@@ -1,10 +1,13 @@
 from collections import OrderedDict
+from threading import Lock
 
-from irclib.util.compare import match_mask
 from sqlalchemy import Boolean, Column, String
 
 from cloudbot import hook
 from cloudbot.util import database, web
+from cloudbot.util.cached_table import CachedTable
+from cloudbot.util.lru import LRUCache
+from cloudbot.util.masks import MaskMatcher
 
 class ignored(database.base):
 	__tablename__ = 'ignored'
@@ -22,24 +25,107 @@ class ignored(database.base):
 		self.status = status
 
 database.metadata.create_all(database.engine)
-ignore_cache = []
+# Global ignores have '*' as their channel
+ignore_cache = CachedTable(ignored.__table__, ('conn', 'chan', 'mask'))
+
+GLOBAL_SCOPE = '*'
+
+
+class IgnoreIndex:
+	"""
+	An immutable index of every ignore, with a matcher for each channel and one for global ignores,
+	which apply on every connection.
+	A changed index is built by `replace_scope`, which reuses the matchers of every other scope.
+
+	:type scopes: dict[object, MaskMatcher]
+	:type results: LRUCache
+	"""
+
+	def __init__(self, scopes=None):
+		self.scopes = scopes or {}
+		# (conn, chan, mask) -> whether it is ignored, dropped along with this index whenever an ignore changes
+		self.results = LRUCache(4096)
+
+	@classmethod
+	def build(cls, cache):
+		"""
+		:type cache: CachedTable
+		"""
+		index = cls()
+		for conn, chan in {key[:2] for key in cache.keys()}:
+			index = index.replace_scope(cache, conn, chan)
+
+		return index
+
+	def replace_scope(self, cache, conn, chan):
+		"""
+		Returns a new index with the matcher for (`conn`, `chan`) rebuilt from `cache`
+
+		:type cache: CachedTable
+		:type conn: str
+		:type chan: str
+		:rtype: IgnoreIndex
+		"""
+		if chan == GLOBAL_SCOPE:
+			key = GLOBAL_SCOPE
+			masks = [_mask for _conn, _chan, _mask in cache.keys() if _chan == GLOBAL_SCOPE]
+		else:
+			key = (conn.casefold(), chan.casefold())
+			masks = list(cache.group(conn, chan))
+
+		scopes = self.scopes.copy()
+		if masks:
+			scopes[key] = MaskMatcher(mask.casefold() for mask in masks)
+		else:
+			scopes.pop(key, None)
+
+		return IgnoreIndex(scopes)
+
+	def is_ignored(self, conn, chan, mask):
+		"""
+		:type conn: str
+		:type chan: str
+		:type mask: str
+		:rtype: bool
+		"""
+		key = (conn.casefold(), chan.casefold(), mask.casefold())
+		result = self.results.get(key)
+		if result is None:
+			conn, chan, mask = key
+			matcher = self.scopes.get(GLOBAL_SCOPE)
+			result = matcher is not None and matcher.match(mask)
+			if not result:
+				matcher = self.scopes.get((conn, chan))
+				result = matcher is not None and matcher.match(mask)
+
+			self.results.put(key, result)
+
+		return result
+
+
+ignore_index = IgnoreIndex()
+# Held while a new index is built from the current one, so concurrent changes can't overwrite each other
+index_lock = Lock()
 
 
 @hook.on_start
 def load_cache(db):
-	new_cache = []
-	for row in db.query(ignored).all():
-		new_cache.append((row.conn, row.chan, row.mask))
+	global ignore_index
+	ignore_cache.load(db)
+	with index_lock:
+		ignore_index = IgnoreIndex.build(ignore_cache)
+
 
-	ignore_cache.clear()
-	ignore_cache.extend(new_cache)
+def update_index(conn, chan):
+	global ignore_index
+	with index_lock:
+		ignore_index = ignore_index.replace_scope(ignore_cache, conn, chan)
 
 
 def find_ignore(conn, chan, mask):
-	search = (conn.casefold(), chan.casefold(), mask.casefold())
-	for _conn, _chan, _mask in ignore_cache:
-		if search == (_conn.casefold(), _chan.casefold(), _mask.casefold()):
-			return _conn, _chan, _mask
+	key = (conn.lower(), chan.lower(), mask.lower())
+	if key in ignore_cache:
+		return key
 
 	return None
 
@@ -55,10 +141,8 @@ def add_ignore(db, conn, chan, mask):
 	if ignore_in_cache(conn, chan, mask):
 		return
 
-	ignore = ignores(conn.name.lower(), chan.lower(), mask.lower())
-	db.add(ignore)
-	db.commit()
-	load_cache(db)
+	ignore_cache.set(db, (conn.lower(), chan.lower(), mask.lower()))
+	update_index(conn.lower(), chan.lower())
 
 
 def remove_ignore(db, conn, chan, mask):
@@ -66,38 +150,13 @@ def remove_ignore(db, conn, chan, mask):
 	if not item:
 		return False
 
-	ignore = db.query(ignores) \
-		.filter(ignores.conn == conn.name.lower()) \
-		.filter(ignores.chan == chan.lower()) \
-		.filter(ignores.mask == mask.lower()) \
-		.first()
-
-	if ignore:
-		db.delete(ignore)
-		db.commit()
-
-	load_cache(db)
+	ignore_cache.delete(db, item)
+	update_index(*item[:2])
 	return True
 
 
 def is_ignored(conn, chan, mask):
-	chan_key = (conn.casefold(), chan.casefold())
-	mask_cf = mask.casefold()
-	for _conn, _chan, _mask in ignore_cache:
-		_mask_cf = _mask.casefold()
-		if _chan == "*":
-			# this is a global ignore
-			if match_mask(mask_cf, _mask_cf):
-				return True
-		else:
-			# this is a channel-specific ignore
-			if chan_key != (_conn.casefold(), _chan.casefold()):
-				continue
-
-			if match_mask(mask_cf, _mask_cf):
-				return True
-
-	return False
+	return ignore_index.is_ignored(conn, chan, mask)
 
 
 # noinspection PyUnusedLocal
@@ -171,9 +230,9 @@ def unignore(text, db, chan, conn, notice, nick, admin_log):
 @hook.command(permissions=["ignore", "chanop"], autohelp=False)
 def listignores(db, conn, chan):
 	"""- List all active ignores for the current channel"""
-	rows = db.query(ignores) \
-		.filter(ignores.conn == conn.name.lower()) \
-		.filter(ignores.chan == chan.lower()) \
+	rows = db.query(ignored) \
+		.filter(ignored.conn == conn.name.lower()) \
+		.filter(ignored.chan == chan.lower()) \
 		.all()
 
 	out = '\n'.join(row.mask for row in rows) + '\n'
@@ -216,9 +275,9 @@ def list_global_ignores(db, conn):
 @hook.command(permissions=["botcontrol", "snoonetstaff"], autohelp=False)
 def list_all_ignores(db, conn, text):
 	"""<chan> - List all ignores for <chan>, requires elevated permissions"""
-	rows = db.query(ignores) \
-		.filter(ignores.conn == conn.name.lower()) \
-		.filter(ignores.chan == text.lower()) \
+	rows = db.query(ignored) \
+		.filter(ignored.conn == conn.name.lower()) \
+		.filter(ignored.chan == text.lower()) \
 		.all()
 
 	ignores = OrderedDict()
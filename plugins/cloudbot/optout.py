@@ -5,7 +5,6 @@ from collections import defaultdict
 from functools import total_ordering
 from threading import RLock
 
-from irclib.util.compare import match_mask
 from sqlalchemy import Column, String, Boolean
 
 from cloudbot import hook
@@ -13,6 +12,7 @@ from cloudbot.hook import Priority
 from cloudbot.util import database, web
 from cloudbot.util.formatting import gen_markdown_table
 from cloudbot.util.mapping import DefaultKeyFoldDict
+from cloudbot.util.masks import MaskMatcher
 from cloudbot.util.text import parse_bool
 
 
@@ -36,6 +36,10 @@ optout_cache = DefaultKeyFoldDict(list)
 
 cache_lock = RLock()
 
+# casefolded network -> NetworkOptOuts, replaced as a whole whenever an opt out changes so the sieve can read it
+# without taking `cache_lock`
+optout_snapshots = {}
+
 
 @total_ordering
 class OptOut:
@@ -44,6 +48,9 @@ class OptOut:
 		self.hook = hook_pattern.casefold()
 		self.allow = allow
 
+		self._channel_matcher = MaskMatcher((self.channel,))
+		self._hook_matcher = MaskMatcher((self.hook,))
+
 	def __lt__(self, other):
 		if isinstance(other, OptOut):
 			diff = len(self.channel) - len(other.channel)
@@ -61,10 +68,82 @@ class OptOut:
 		return "{}({}, {}, {})".format(self.__class__.__name__, self.channel, self.hook, self.allow)
 
 	def match(self, channel, hook_name):
-		return self.match_chan(channel) and match_mask(hook_name.casefold(), self.hook)
+		return self.match_chan(channel) and self.match_hook(hook_name)
 
 	def match_chan(self, channel):
-		return match_mask(channel.casefold(), self.channel)
+		return self._channel_matcher.match(channel.casefold())
+
+	def match_hook(self, hook_name):
+		return self._hook_matcher.match(hook_name.casefold())
+
+
+class NetworkOptOuts:
+	"""
+	An immutable snapshot of the opt outs for a network, which caches the decision made for each channel and hook
+	"""
+
+	# The most decisions to keep, they are all dropped once there are more than this
+	MAX_DECISIONS = 10000
+
+	__slots__ = ('optouts', '_decisions', '_channels')
+
+	def __init__(self, optouts=()):
+		self.optouts = tuple(sorted(optouts, reverse=True))
+		# (channel, hook name) -> whether the hook is allowed
+		self._decisions = {}
+		# channel -> the opt outs whose channel pattern matches it, in priority order
+		self._channels = {}
+
+	def _get_channel_optouts(self, channel):
+		opts = self._channels.get(channel)
+		if opts is None:
+			opts = tuple(opt for opt in self.optouts if opt.match_chan(channel))
+			if len(self._channels) >= self.MAX_DECISIONS:
+				self._channels.clear()
+
+			self._channels[channel] = opts
+
+		return opts
+
+	def is_allowed(self, channel, hook_name):
+		"""
+		:type channel: str
+		:type hook_name: str
+		:rtype: bool
+		"""
+		key = (channel.casefold(), hook_name.casefold())
+		allowed = self._decisions.get(key)
+		if allowed is None:
+			allowed = True
+			for _optout in self._get_channel_optouts(key[0]):
+				if _optout.match_hook(key[1]):
+					allowed = _optout.allow
+					break
+
+			if len(self._decisions) >= self.MAX_DECISIONS:
+				self._decisions.clear()
+
+			self._decisions[key] = allowed
+
+		return allowed
+
+
+def publish_optouts(*networks):
+	"""
+	Replaces the snapshots for `networks` with ones built from `optout_cache`, or every network if none are given.
+	Must be called with `cache_lock` held.
+	"""
+	global optout_snapshots
+	if networks:
+		new_snapshots = optout_snapshots.copy()
+	else:
+		new_snapshots = {}
+		networks = optout_cache.keys()
+
+	for network in networks:
+		new_snapshots[network.casefold()] = NetworkOptOuts(optout_cache.get(network, ()))
+
+	optout_snapshots = new_snapshots
 
 
 async def check_channel_permissions(event, chan, *perms):
@@ -103,12 +182,21 @@ def set_optout(db, conn, chan, pattern, allowed):
 		.filter(optouts.hook == pattern.casefold()) \
 		.first()
 
-	if not res:
-		opt = optouts(conn.casefold(), chan.casefold(), pattern.casefold())
-		db.add(opt)
-		db.commit()
+	if res:
+		res.allow = allowed
+	else:
+		db.add(optouts(conn.casefold(), chan.casefold(), pattern.casefold(), allowed))
+
+	db.commit()
 
-	load_cache(db)
+	new_opt = OptOut(chan, pattern, allowed)
+	with cache_lock:
+		opts = optout_cache[conn]
+		opts[:] = [opt for opt in opts if (opt.channel, opt.hook) != (new_opt.channel, new_opt.hook)]
+		opts.append(new_opt)
+		# Keep the same order as load_cache, so listings show the highest priority first
+		opts.sort(reverse=True)
+		publish_optouts(conn)
 
 
 def del_optout(db, conn, chan, pattern):
@@ -122,9 +210,13 @@ def del_optout(db, conn, chan, pattern):
 		db.delete(res)
 		db.commit()
 
-	load_cache(db)
+	key = (chan.casefold(), pattern.casefold())
+	with cache_lock:
+		opts = optout_cache[conn]
+		opts[:] = [opt for opt in opts if (opt.channel, opt.hook) != key]
+		publish_optouts(conn)
 
-	return res.rowcount > 0
+	return res is not None
 
 
 def clear_optout(db, conn, chan=None):
@@ -143,16 +235,23 @@ def clear_optout(db, conn, chan=None):
 			db.delete(r)
 		db.commit()
 
-	load_cache(db)
+	with cache_lock:
+		opts = optout_cache[conn]
+		if chan:
+			opts[:] = [opt for opt in opts if opt.channel != chan.casefold()]
+		else:
+			opts.clear()
+
+		publish_optouts(conn)
 
-	return res.rowcount
+	return len(res)
 
 
 @hook.onload
 def load_cache(db):
 	new_cache = defaultdict(list)
 	for row in db.query(optouts).all():
-		new_cache[row["network"]].append(OptOut(row.chan, row.hook, row.allow))
+		new_cache[row.network].append(OptOut(row.chan, row.hook, row.allow))
 
 	for opts in new_cache.values():
 		opts.sort(reverse=True)
@@ -160,6 +259,7 @@ def load_cache(db):
 	with cache_lock:
 		optout_cache.clear()
 		optout_cache.update(new_cache)
+		publish_optouts()
 
 
 # noinspection PyUnusedLocal
@@ -171,18 +271,16 @@ def optout_sieve(bot, event, _hook):
 	if _hook.plugin.title.startswith('core.'):
 		return event
 
-	hook_name = _hook.plugin.title + "." + _hook.function_name
-	with cache_lock:
-		_optouts = get_conn_optouts(event.conn.name)
-		for _optout in _optouts:
-			if _optout.match(event.chan, hook_name):
-				if not _optout.allow:
-					if _hook.type == "command":
-						event.notice("Sorry, that command is disabled in this channel.")
+	_optouts = optout_snapshots.get(event.conn.name.casefold())
+	if _optouts is None:
+		return event
 
-					return None
+	hook_name = _hook.plugin.title + "." + _hook.function_name
+	if not _optouts.is_allowed(event.chan, hook_name):
+		if _hook.type == "command":
+			event.notice("Sorry, that command is disabled in this channel.")
 
-				break
+		return None
 
 	return event
 
@@ -4,6 +4,7 @@ from sqlalchemy import Column, String
 
 from cloudbot import hook
 from cloudbot.util import database
+from cloudbot.util.cached_table import CachedTable
 
 
 class regex_chans(database.base):
@@ -24,7 +25,7 @@ class regex_chans(database.base):
 # If False, all channels without a setting will have regex disabled
 default_enabled = True
 database.metadata.create_all(database.engine)
-status_cache = {}
+status_cache = CachedTable(regex_chans.__table__, ('conn', 'chan'), 'status')
 logger = logging.getLogger("cloudbot")
 
 
@@ -33,38 +34,15 @@ def load_cache(db):
 	"""
 	:type db: sqlalchemy.orm.Session
 	"""
-	new_cache = {}
-	for row in db.query(regex_chans).all():
-		new_cache[(row.conn, row.chan)] = row.status
-
-	status_cache.clear()
-	status_cache.update(new_cache)
+	status_cache.load(db)
 
 
 def set_status(db, conn, chan, status):
-	if (conn, chan) in status_cache:
-		regex_chan = db.query(regex_chans) \
-			.filter(regex_chans.conn == conn) \
-			.filter(regex_chans.chan == chan) \
-			.first()
-
-		regex_chan.status = status
-	else:
-		regex_chan = regex_chans(conn, chan, status)
-		db.add(regex_chan)
-
-	db.commit()
+	status_cache.set(db, (conn, chan), status)
 
 
 def delete_status(db, conn, chan):
-	regex_chan = db.query(regex_chans) \
-		.filter(regex_chans.conn == conn) \
-		.filter(regex_chans.chan == chan) \
-		.first()
-
-	if regex_chan:
-		db.delete(regex_chan)
-		db.commit()
+	status_cache.delete(db, (conn, chan))
 
 
 @hook.sieve()
@@ -97,7 +75,6 @@ def change_status(db, event, status):
 		action, channel
 	))
 	set_status(db, event.conn.name, channel, "ENABLED" if status else "DISABLED")
-	load_cache(db)
 
 
 @hook.command(autohelp=False, permissions=["botcontrol"])
@@ -126,7 +103,6 @@ def resetregex(text, db, conn, chan, nick, message, notice):
 	message("Resetting regex matching setting (youtube, etc) (issued by {})".format(nick), target=channel)
 	notice("Resetting regex matching setting (youtube, etc) in channel {}".format(channel))
 	delete_status(db, conn.name, channel)
-	load_cache(db)
 
 
 @hook.command(autohelp=False, permissions=["botcontrol"])
@@ -139,7 +115,7 @@ def regexstatus(text, conn, chan):
 		channel = text
 	else:
 		channel = "#{}".format(text)
-	status = status_cache.get((conn.name, chan))
+	status = status_cache.get((conn.name, channel))
 	if status is None:
 		if default_enabled:
 			status = "ENABLED"
@@ -152,8 +128,6 @@ def regexstatus(text, conn, chan):
 def listregex(conn):
 	"""- List non-default regex statuses for channels"""
 	values = []
-	for (conn_name, chan), status in status_cache.values():
-		if conn_name != conn.name:
-			continue
+	for chan, status in sorted(status_cache.group(conn.name).items()):
 		values.append("{}: {}".format(chan, status))
 	return ", ".join(values)
@@ -31,6 +31,7 @@ def clear_isupport(conn):
 
     isupport_data = serv_info.setdefault("isupport_tokens", {})
     isupport_data.clear()
+    serv_info.pop("targmax", None)
 
 
 def handle_prefixes(data, serv_info):
@@ -64,6 +65,15 @@ def handle_extbans(value, serv_info):
     serv_info["extban_prefix"] = pfx
 
 
+def handle_targmax(value, serv_info):
+    targmax = serv_info.setdefault("targmax", {})
+    targmax.clear()
+    for item in value.split(','):
+        command, _, limit = item.partition(':')
+        # No limit given means there is no limit
+        targmax[command.upper()] = int(limit) if limit else None
+
+
 @hook.irc_raw('005', singlethread=True)
 def on_isupport(conn, irc_paramlist):
     serv_info = conn.memory["server_info"]
@@ -79,3 +89,5 @@ def on_isupport(conn, irc_paramlist):
             handle_chan_modes(value, serv_info)
         elif name == "EXTBAN":
             handle_extbans(value, serv_info)
+        elif name == "TARGMAX":
+            handle_targmax(value, serv_info)
@@ -6,6 +6,7 @@ from sqlalchemy import Column, String
 from cloudbot import hook
 from cloudbot.bot import bot
 from cloudbot.util import database, http, web
+from cloudbot.util.cached_table import CachedTable
 
 
 geo_url = 'https://maps.googleapis.com/maps/api/geocode/json'
@@ -24,7 +25,7 @@ class locs(database.base):
         self.loc = loc
 
 database.metadata.create_all(database.engine)
-location_cache = {}
+location_cache = CachedTable(locs.__table__, ('nick',), 'loc')
 
 BEARINGS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
             'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
@@ -37,26 +38,12 @@ BEARING_RANGE = BEARING_SECTION / 2
 
 @hook.on_start
 def load_cache(db):
-    new_cache = {}
-    for row in db.query(locs).all():
-        new_cache[row.nick] = row.loc
-
-    location_cache.clear()
-    location_cache.update(new_cache)
+    location_cache.load(db)
 
 
 def add_location(nick, location, db):
-    if location_cache.get(nick):
-        loc = db.query(locs) \
-            .filter(locs.nick == nick.lower()) \
-            .first()
-        loc.loc = location
-    else:
-        loc = locs(nick.lower(), location)
-        db.add(loc)
-
-    db.commit()
-    load_cache(db)
+    if location_cache.get(nick.lower()) != location:
+        location_cache.set(db, nick.lower(), location)
 
 
 def strftime(time):
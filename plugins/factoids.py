@@ -1,10 +1,10 @@
 import re
 
-from collections import defaultdict
 from sqlalchemy import Column, String
 
 from cloudbot import hook
 from cloudbot.util import database, formatting
+from cloudbot.util.cached_table import CachedTable
 
 
 remember_re = re.compile(r'^(?P<replace>no )?G2[:, ]+(?P<word>(?!\().+?(?!\()|\(.+\)) is (?P<append>also )?(?P<data>.+)$', re.I)
@@ -25,55 +25,27 @@ class factoids(database.base):
         self.data = data
 
 database.metadata.create_all(database.engine)
-factoid_cache = defaultdict({}.copy)
+factoid_cache = CachedTable(factoids.__table__, ('chan', 'word'), 'data')
 
 
 @hook.on_start()
 def load_cache(db):
-    new_cache = defaultdict({}.copy)
-    for row in db.query(factoids).all():
-        new_cache[row.chan][row.word] = row.data
-
-    factoid_cache.clear()
-    factoid_cache.update(new_cache)
+    factoid_cache.load(db)
 
 
 def add_factoid(db, word, chan, data, nick):
-    if word in factoid_cache[chan]:
-        factoid = db.query(factoids) \
-            .filter(factoids.chan == chan) \
-            .filter(factoids.word.lower() == word.lower()) \
-            .first()
-        factoid.data = data
-    else:
-        factoid = factoids(word, chan, data)
-        db.add(factoid)
-
-    db.commit()
-    load_cache(db)
+    factoid_cache.set(db, (chan, word), data)
 
 
 def del_factoid(db, chan, word):
-    factoid = db.query(factoids) \
-        .filter(factoids.chan == chan) \
-        .filter(factoids.word.lower() == word.lower()) \
-        .first()
-
-    if factoid:
-        db.delete(factoid)
-        db.commit()
-
-    load_cache(db)
+    factoid_cache.delete(db, (chan, word))
 
 
 @hook.regex(remember_re)
 def remember(match, nick, chan, db, message):
     match = match.groupdict()
 
-    try:
-        old_data = factoid_cache[chan][match['word']]
-    except LookupError:
-        old_data = None
+    old_data = factoid_cache.get((chan, match['word']))
 
     if old_data:
         if match.get('replace', False):
@@ -93,7 +65,7 @@ def remember(match, nick, chan, db, message):
 @hook.command
 def forget(text, chan, db, message):
     """<word> - Remove factoids with the specified names."""
-    if text in factoid_cache[chan]:
+    if (chan, text) in factoid_cache:
         del_factoid(db, chan, text)
         message(f"I forgot {text}")
 
@@ -101,12 +73,13 @@ def forget(text, chan, db, message):
 @hook.regex(factoid_re)
 def factoid(match, chan, message, action):
     """<word> - shows what data is associated with <word>."""
-    if match['word'] in factoid_cache[chan]:
-        message(f"{match['word']} is {factoid_cache[chan][match['word']]}")
+    data = factoid_cache.get((chan, match['word']))
+    if data is not None:
+        message(f"{match['word']} is {data}")
 
 
 @hook.command("factoids", autohelp=False)
 def list_factoids(chan, message):
     """- lists all available factoids."""
-    message(formatting.truncate_str(", ".join(sorted(factoid_cache[chan].keys())), 400) or "None")
+    message(formatting.truncate_str(", ".join(sorted(factoid_cache.group(chan))), 400) or "None")
 
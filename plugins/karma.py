@@ -1,9 +1,8 @@
-import operator
+import heapq
 import re
-from collections import defaultdict
+from threading import Lock
 
-import sqlalchemy
-from sqlalchemy import String, Column, Integer
+from sqlalchemy import String, Column, Index, Integer, and_, bindparam, select
 
 from cloudbot import hook
 from cloudbot.util import database
@@ -11,9 +10,22 @@ from cloudbot.util import database
 karmaplus_re = re.compile(r'(.*)\+\+')
 karmaminus_re = re.compile(r'(.*)--')
 
+# Seconds between writes to the database
+FLUSH_INTERVAL = 10
+# Write straight away once this many things have pending changes
+FLUSH_SIZE = 100
+
+# The most entries a leaderboard can show
+MAX_LEADERBOARD = 10
+
+
 class karma(database.base):
     __tablename__ = 'karma'
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        # (chan, thing) is covered by the primary key
+        Index('karma_thing_idx', 'thing'),
+        {'extend_existing': True},
+    )
 
     chan = Column(String, primary_key=True)
     thing = Column(String, primary_key=True)
@@ -27,74 +39,269 @@ class karma(database.base):
         self.score = score
 
 
-def update_score(nick, chan, thing, score, db):
-    if nick.casefold() == chan.casefold():
-        return
+table = karma.__table__
 
-    _karma = db.query(karma) \
-        .filter(karma.chan == chan) \
-        .filter(karma.nick == nick.lower()) \
-        .filter(karma.thing == thing.lower()) \
-        .all()
+update_query = table.update().where(and_(
+    table.c.chan == bindparam('b_chan'), table.c.thing == bindparam('b_thing')
+)).values(score=table.c.score + bindparam('b_delta'), nick=bindparam('b_nick'))
 
-    if _karma:
-        _karma.score += score
-    else:
-        _karma = karma(chan, thing.lower(), nick.lower(), score)
-        db.add(_karma)
 
-    db.commit()
+class KarmaEngine:
+    """
+    Keeps every score in memory, with per-channel and global aggregates, and collects changes to be written to the
+    database in batches
+
+    :type scores: dict[str, dict[str, int]]
+    :type channels: dict[str, dict[str, int]]
+    :type totals: dict[str, int]
+    """
+
+    def __init__(self):
+        # chan -> thing -> score
+        self.scores = {}
+        # thing -> chan -> score, to total a thing's score without going through every channel
+        self.channels = {}
+        # thing -> score across all channels
+        self.totals = {}
+
+        # Changes which haven't been written to the database yet, {(chan, thing): (delta, nick)}
+        self.pending = {}
+        # Every (chan, thing) with a row in the database
+        self._stored = set()
+
+        self._lock = Lock()
+        # Makes sure batches are written in the order they were taken
+        self._flush_lock = Lock()
+
+    def load(self, db):
+        """
+        :type db: sqlalchemy.orm.Session
+        """
+        with self._flush_lock:
+            rows = db.execute(select([table.c.chan, table.c.thing, table.c.score])).fetchall()
+            with self._lock:
+                self.scores = {}
+                self.channels = {}
+                self.totals = {}
+                self._stored = set()
+                for chan, thing, score in rows:
+                    self._apply(chan, thing, score or 0)
+                    self._stored.add((chan, thing))
+
+                for (chan, thing), (delta, _) in self.pending.items():
+                    self._apply(chan, thing, delta)
+
+    def _apply(self, chan, thing, delta):
+        chan_scores = self.scores.setdefault(chan, {})
+        chan_scores[thing] = chan_scores.get(thing, 0) + delta
+        self.channels.setdefault(thing, {})[chan] = chan_scores[thing]
+        self.totals[thing] = self.totals.get(thing, 0) + delta
+
+    def add(self, chan, thing, nick, delta):
+        """
+        :return: True if enough changes are pending that they should be flushed
+        :rtype: bool
+        """
+        key = (chan, thing)
+        with self._lock:
+            self._apply(chan, thing, delta)
+            old_delta = self.pending.get(key, (0, None))[0]
+            self.pending[key] = (old_delta + delta, nick)
+            return len(self.pending) >= FLUSH_SIZE
+
+    def get(self, chan, thing):
+        """
+        :rtype: int | None
+        """
+        return self.scores.get(chan, {}).get(thing)
+
+    def get_global(self, thing):
+        """
+        Returns the total score for `thing` across every channel, and the totals of its positive and negative scores
+
+        :rtype: (int, int, int) | None
+        """
+        with self._lock:
+            chan_scores = list(self.channels.get(thing, {}).values())
+
+        if not chan_scores:
+            return None
+
+        pos = sum(score for score in chan_scores if score > 0)
+        neg = sum(score for score in chan_scores if score < 0)
+        return pos + neg, pos, neg
+
+    def leaderboard(self, count, chan=None, lowest=False):
+        """
+        Returns the `count` highest (or lowest) scored things in `chan`, or across every channel if it isn't given
+
+        :rtype: list[(str, int)]
+        """
+        with self._lock:
+            scores = list((self.totals if chan is None else self.scores.get(chan, {})).items())
+
+        select_func = heapq.nsmallest if lowest else heapq.nlargest
+        return select_func(count, scores, key=lambda item: item[1])
+
+    def flush(self, db):
+        """
+        Writes all pending changes to the database in one transaction
+
+        :type db: sqlalchemy.orm.Session
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self.pending:
+                    return
+
+                batch = self.pending
+                self.pending = {}
+
+            updates = []
+            inserts = []
+            for (chan, thing), (delta, nick) in batch.items():
+                if (chan, thing) in self._stored:
+                    updates.append({'b_chan': chan, 'b_thing': thing, 'b_delta': delta, 'b_nick': nick})
+                else:
+                    inserts.append({'chan': chan, 'thing': thing, 'nick': nick, 'score': delta})
+
+            try:
+                if updates:
+                    db.execute(update_query, updates)
+
+                if inserts:
+                    db.execute(table.insert(), inserts)
+
+                db.commit()
+            except Exception:
+                db.rollback()
+                with self._lock:
+                    # Put the batch back, combined with anything which has changed since
+                    for key, (delta, nick) in batch.items():
+                        new_delta, new_nick = self.pending.get(key, (0, nick))
+                        self.pending[key] = (delta + new_delta, new_nick)
+
+                raise
+
+            self._stored.update((row['chan'], row['thing']) for row in inserts)
+
+
+engine = KarmaEngine()
+
+
+@hook.on_start
+def load_karma(db):
+    """
+    :type db: sqlalchemy.orm.Session
+    """
+    engine.load(db)
+
+
+@hook.periodic(FLUSH_INTERVAL, initial_interval=FLUSH_INTERVAL)
+def flush_karma(db):
+    """
+    :type db: sqlalchemy.orm.Session
+    """
+    engine.flush(db)
+
+
+@hook.on_stop
+def flush_karma_on_stop(db):
+    """
+    :type db: sqlalchemy.orm.Session
+    """
+    engine.flush(db)
+
+
+def update_score(nick, chan, thing, score, bot):
+    """
+    :type bot: cloudbot.bot.CloudBot
+    """
+    thing = thing.strip().lower()
+    # Karma is only counted in channels, and no one can change their own
+    if not thing or nick.casefold() == chan.casefold() or nick.casefold() == thing.casefold():
+        return
+
+    if engine.add(chan, thing, nick.lower(), score):
+        db = bot.db_session()
+        try:
+            engine.flush(db)
+        finally:
+            db.close()
 
 
 @hook.regex(karmaplus_re)
-def increment(match, nick, chan, db):
-    update_score(match.group(1), nick, chan, 1, db)
+def increment(match, nick, chan, bot):
+    update_score(nick, chan, match.group(1), 1, bot)
 
 
 @hook.regex(karmaminus_re)
-def decrement(match, nick, chan, db):
-    update_score(match.group(1), nick, chan, -1, db)
+def decrement(match, nick, chan, bot):
+    update_score(nick, chan, match.group(1), -1, bot)
 
 
-@hook.command(autohelp=False)
-def karma(text, chan, message, db):
-    """<thing> - will print the total points for <thing> in the channel."""
-    try:
-        text = [t for t in text.split(' ') if t]
-        text.remove('-g')
-        g = True
-        text = ' '.join(text)
-    except:
-        g = False
-        text = ' '.join(text)
+def parse_global(text):
+    """
+    Removes a -g flag from the arguments
+
+    :return: The remaining arguments, and whether the flag was given
+    :rtype: (list[str], bool)
+    """
+    args = text.split()
+    if '-g' in args:
+        args.remove('-g')
+        return args, True
+
+    return args, False
+
+
+@hook.command("karma", autohelp=False)
+def karma_cmd(text, chan, message):
+    """[-g] <thing> - will print the total points for <thing> in the channel, or in every channel with -g."""
+    args, g = parse_global(text)
+    text = ' '.join(args)
+    thing = text.lower()
 
     if g:
-        data = db.query(karma) \
-             .filter(karma.nick == nick.lower()) \
-             .filter(karma.thing == text.lower()) \
-             .all()
-    else:
-        data = db.query(karma) \
-             .filter(karma.chan == chan) \
-             .filter(karma.nick == nick.lower()) \
-             .filter(karma.thing == text.lower()) \
-             .all()
-
-    if data:
-        print(data)
-        score = 0
-        pos = 0
-        neg = 0
-        for k in data:
-            if int(k[0]) < 0:
-                neg += int(k[0])
-            else:
-                pos += int(k[0])
-            score += int(k[0])
-        if g:
+        data = engine.get_global(thing)
+        if data is not None:
+            score, pos, neg = data
             message(f"{text} has a total score of {score} (+{pos}/{neg}) across all channels I know about.")
-        else:
-            message(f"{text} has a total score of {score} (+{pos}/{neg}) in {chan}.")
+            return
     else:
-        return f"I couldn't find {text} in the database."
+        score = engine.get(chan, thing)
+        if score is not None:
+            pos, neg = (score, 0) if score >= 0 else (0, score)
+            message(f"{text} has a total score of {score} (+{pos}/{neg}) in {chan}.")
+            return
+
+    return f"I couldn't find {text} in the database."
+
+
+def show_leaderboard(text, chan, lowest):
+    args, g = parse_global(text)
+    try:
+        count = min(int(args[0]), MAX_LEADERBOARD) if args else 5
+    except ValueError:
+        return "Please give the number of entries to show."
+
+    entries = engine.leaderboard(max(count, 1), None if g else chan, lowest)
+    if not entries:
+        return "No karma has been given yet."
+
+    where = "across all channels" if g else f"in {chan}"
+    return "{} karma {}: {}".format(
+        "Lowest" if lowest else "Highest", where, ", ".join(f"{thing} ({score})" for thing, score in entries)
+    )
+
+
+@hook.command("topkarma", autohelp=False)
+def top_karma(text, chan):
+    """[-g] [count] - shows the things with the most karma in the channel, or in every channel with -g."""
+    return show_leaderboard(text, chan, False)
+
 
+@hook.command("bottomkarma", autohelp=False)
+def bottom_karma(text, chan):
+    """[-g] [count] - shows the things with the least karma in the channel, or in every channel with -g."""
+    return show_leaderboard(text, chan, True)
@@ -7,6 +7,7 @@ from sqlalchemy import Column, String
 from cloudbot import hook
 from cloudbot.bot import bot
 from cloudbot.util import database, http, web
+from cloudbot.util.cached_table import CachedTable
 
 api_url = "http://ws.audioscrobbler.com/2.0/?format=json"
 
@@ -22,17 +23,12 @@ class lfmusers(database.base):
         self.acc = acc
 
 database.metadata.create_all(database.engine)
-last_cache = {}
+last_cache = CachedTable(lfmusers.__table__, ('nick',), 'acc')
 
 
 @hook.on_start()
 def load_cache(db):
-    new_cache = {}
-    for row in db.query(lfmusers).all():
-        new_cache[row.nick] = row.acc
-
-    last_cache.clear()
-    last_cache.update(new_cache)
+    last_cache.load(db)
 
 
 def api_request(method, **params):
@@ -117,19 +113,7 @@ def check_key_and_user(db, nick, text=None, save=True):
         return None, "Error: No API key set."
 
     if text and save:
-        if get_account(nick):
-            lfmuser = db.query(lfmusers) \
-                .filter(lfmusers.nick == nick.lower()) \
-                .first()
-
-            lfmuser.acc = text
-            db.commit()
-        else:
-            lfmuser = lfmusers(nick.lower(), text)
-            db.add(lfmuser)
-            db.commit()
-
-        load_cache(db)
+        last_cache.set(db, nick.lower(), text)
 
     user = get_account(nick)
 
@@ -79,6 +79,71 @@ async def threaddump_command():
     return get_thread_dump()
 
 
+@hook.command("dbpool", autohelp=False, permissions=["botcontrol"])
+def db_pool_stats(bot):
+    """- Show usage of the database worker threads used by coroutine hooks"""
+    stats = bot.db_executor_pool.stats()
+    return (
+        "Database workers: {in_use}/{size} in use (max {max_size}), {queue_depth} waiting. "
+        "{leases} leases, average wait {average_wait:.3f}s, max wait {max_wait:.3f}s"
+    ).format(**stats)
+
+
+@hook.command("hookqueue", autohelp=False, permissions=["botcontrol"])
+def hook_queue_stats(bot):
+    """- Show how many hooks are running and queued, and how long they have waited to start"""
+    stats = bot.plugin_manager.scheduler.stats()
+    waits = ", ".join("{}: {}".format(bucket, count) for bucket, count in stats["wait_times"].items())
+    dropped = ", ".join("{}: {}".format(_type, count) for _type, count in sorted(stats["dropped"].items()))
+    return "Hooks running: {}, queued: {}. Wait times: {}. Dropped: {}".format(
+        stats["in_flight"], stats["queue_length"], waits, dropped or "none"
+    )
+
+
+@hook.command("executors", autohelp=False, permissions=["botcontrol"])
+def executor_stats(bot):
+    """- Show usage of the thread pools threaded hooks run in"""
+    stats = bot.plugin_manager.executors.stats()
+    return "; ".join(
+        "{name}: {active}/{workers} active, {queued} queued, {completed} done, {utilisation:.1%} utilised".format(
+            name=name, **pool
+        )
+        for name, pool in sorted(stats.items())
+    )
+
+
+@hook.command("sendqueue", autohelp=False, permissions=["botcontrol"])
+def send_queue_stats(conn):
+    """- Show how many outgoing lines are waiting to be sent on this connection, and how fast they are going out"""
+    if conn.send_queue is None:
+        return "Not connected."
+
+    stats = conn.send_queue.stats()
+    lanes = ", ".join("{}: {}".format(name, depth) for name, depth in stats["lanes"].items())
+    return "Send queue: {depth} waiting ({lanes}). {sent} sent, {dropped} dropped, {drain_rate:.2f} lines/s".format(
+        lanes=lanes, **stats
+    )
+
+
+@hook.command("decodestats", autohelp=False, permissions=["botcontrol"])
+def decode_stats(conn):
+    """- Show how incoming lines on this connection have been decoded"""
+    stats = conn.decoder.stats()
+    codecs = ", ".join("{}: {}".format(codec, count) for codec, count in sorted(stats["codecs"].items()))
+    return (
+        "{lines} lines received, {ascii} ASCII, {fallback} not {encoding}, {failed} undecodable. "
+        "Fallbacks used: {codecs}. Encodings remembered for {senders} senders"
+    ).format(codecs=codecs or "none", **stats)
+
+
+@hook.command("permcache", autohelp=False, permissions=["botcontrol"])
+def permission_cache_stats(conn):
+    """- Show how often permission checks on this connection were answered from the cache"""
+    return "Permission cache: {size}/{maxsize} masks, {hits} hits, {misses} misses ({hit_rate:.1%} hit rate)".format(
+        **conn.permissions.cache_stats()
+    )
+
+
 @hook.command("objtypes", autohelp=False, permissions=["botcontrol"])
 def show_types():
     """- Print object type data to the console"""
@@ -1,10 +1,14 @@
+import logging
 import random
 import re
 import sqlalchemy
 import time
+from array import array
+from bisect import bisect_left, insort
+from threading import Lock
 
 from sqlalchemy import Column, String, Integer, Boolean
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.types import REAL
 
 from cloudbot import hook
@@ -26,6 +30,332 @@ class quotes(database.base):
         self.time = time
 
 
+logger = logging.getLogger("cloudbot")
+
+# FTS5's trigram tokenizer can only match terms of at least this many characters
+FTS_MIN_LENGTH = 3
+
+
+class ActiveQuotes:
+    """
+    The ids of every active quote, in an array with each id's position so ids can be added, removed
+    or picked at random in O(1)
+    """
+
+    def __init__(self):
+        self._ids = []
+        self._positions = {}
+        self._lock = Lock()
+
+    def load(self, db):
+        ids = [row[0] for row in db.execute(sqlalchemy.select([quotes.id]).where(quotes.active == True))]
+        with self._lock:
+            self._ids = ids
+            self._positions = {quote_id: i for i, quote_id in enumerate(ids)}
+
+    def add(self, quote_id):
+        with self._lock:
+            if quote_id not in self._positions:
+                self._positions[quote_id] = len(self._ids)
+                self._ids.append(quote_id)
+
+    def discard(self, quote_id):
+        with self._lock:
+            pos = self._positions.pop(quote_id, None)
+            if pos is None:
+                return
+
+            # Move the last id into the gap
+            last = self._ids.pop()
+            if last != quote_id:
+                self._ids[pos] = last
+                self._positions[last] = pos
+
+    def __contains__(self, quote_id):
+        return quote_id in self._positions
+
+    def __len__(self):
+        return len(self._ids)
+
+    def choice(self):
+        """
+        :rtype: int | None
+        """
+        with self._lock:
+            if not self._ids:
+                return None
+
+            return random.choice(self._ids)
+
+
+def has_cased_non_ascii(char):
+    return not char.isascii() and char.lower() != char.upper()
+
+
+def make_like_pattern(text, any_case=False):
+    """
+    Returns a LIKE pattern for quotes containing `text`, escaped with a backslash
+
+    :param any_case: Match any character in place of each non-ASCII letter, as SQLite's LIKE can't ignore their case
+    :type text: str
+    :type any_case: bool
+    :rtype: str
+    """
+    pattern = re.sub(r'([%_\\])', r'\\\1', text)
+    if any_case:
+        pattern = ''.join('_' if has_cased_non_ascii(char) else char for char in pattern)
+
+    return '%' + pattern + '%'
+
+
+def make_glob_pattern(text):
+    """
+    Returns an SQLite GLOB pattern for quotes containing `text`, ignoring case.
+    Unlike SQLite's LIKE, this ignores the case of non-ASCII letters too.
+
+    :type text: str
+    :rtype: str
+    """
+    parts = []
+    for char in text:
+        variants = {variant for variant in (char, char.lower(), char.upper()) if len(variant) == 1}
+        if len(variants) > 1 or char in '*?[':
+            parts.append('[' + ''.join(sorted(variants)) + ']')
+        else:
+            parts.append(char)
+
+    return '*' + ''.join(parts) + '*'
+
+
+def match_quotes(db, text, ids=None):
+    """
+    Returns the ids of the quotes containing `text`, ignoring case, matching '%', '_' and non-ASCII letters
+    the same way FTS5 does
+
+    :param ids: The quotes to check, every quote if not given
+    :type ids: list[int] | None
+    :rtype: list[int]
+    """
+    if db.get_bind().dialect.name != 'sqlite':
+        condition = quotes.quote.ilike(make_like_pattern(text), escape='\\')
+    elif any(map(has_cased_non_ascii, text)):
+        # SQLite's LIKE only ignores the case of ASCII letters, so narrow the matches down with it before the slower GLOB
+        condition = sqlalchemy.and_(
+            quotes.quote.like(make_like_pattern(text, True), escape='\\'),
+            quotes.quote.op('GLOB')(make_glob_pattern(text)),
+        )
+    else:
+        condition = quotes.quote.like(make_like_pattern(text), escape='\\')
+
+    query = sqlalchemy.select([quotes.id]).where(condition).order_by(quotes.id)
+    if ids is None:
+        return [row[0] for row in db.execute(query)]
+
+    found = []
+    # Stay under SQLite's bound parameter limit
+    for i in range(0, len(ids), 500):
+        found.extend(row[0] for row in db.execute(query.where(quotes.id.in_(ids[i:i + 500]))))
+
+    found.sort()
+    return found
+
+
+class FtsIndex:
+    """
+    An SQLite FTS5 table over the quote text, using the trigram tokenizer so it matches substrings like LIKE does.
+    Triggers on the quotes table keep it up to date, however quotes are added.
+    """
+
+    name = "fts5"
+
+    TRIGGERS = {
+        "quotes_fts_insert": "AFTER INSERT ON quotes BEGIN "
+                             "INSERT INTO quotes_fts(rowid, quote) VALUES (new.id, new.quote); END",
+        "quotes_fts_delete": "AFTER DELETE ON quotes BEGIN "
+                             "INSERT INTO quotes_fts(quotes_fts, rowid, quote) VALUES ('delete', old.id, old.quote); "
+                             "END",
+        "quotes_fts_update": "AFTER UPDATE OF quote ON quotes BEGIN "
+                             "INSERT INTO quotes_fts(quotes_fts, rowid, quote) VALUES ('delete', old.id, old.quote); "
+                             "INSERT INTO quotes_fts(rowid, quote) VALUES (new.id, new.quote); END",
+    }
+
+    def load(self, db):
+        """
+        Creates the index table and its triggers if needed, raising OperationalError if FTS5 isn't available
+
+        :type db: sqlalchemy.orm.Session
+        """
+        existing = {row[0] for row in db.execute(sqlalchemy.text(
+            "SELECT name FROM sqlite_master WHERE name = 'quotes_fts' OR name LIKE 'quotes_fts\\_%' ESCAPE '\\'"
+        ))}
+        if "quotes_fts" in existing and existing.issuperset(self.TRIGGERS):
+            return
+
+        if "quotes_fts" not in existing:
+            db.execute(sqlalchemy.text(
+                "CREATE VIRTUAL TABLE quotes_fts USING fts5("
+                "quote, content='quotes', content_rowid='id', tokenize='trigram')"
+            ))
+
+        for name, trigger in self.TRIGGERS.items():
+            if name not in existing:
+                db.execute(sqlalchemy.text("CREATE TRIGGER {} {}".format(name, trigger)))
+
+        # Quotes may have been added while the table or its triggers were missing
+        db.execute(sqlalchemy.text("INSERT INTO quotes_fts(quotes_fts) VALUES ('rebuild')"))
+        db.commit()
+
+    def add(self, db, quote_id, text):
+        # Added by the insert trigger
+        pass
+
+    def search(self, db, text):
+        """
+        Returns the ids of every quote containing `text`, or None if the index can't be used for it
+
+        :rtype: list[int] | None
+        """
+        if len(text) < FTS_MIN_LENGTH:
+            return None
+
+        phrase = '"{}"'.format(text.replace('"', '""'))
+        rows = db.execute(
+            sqlalchemy.text("SELECT rowid FROM quotes_fts WHERE quotes_fts MATCH :phrase ORDER BY rowid"),
+            {"phrase": phrase}
+        )
+        return [row[0] for row in rows]
+
+
+class WordIndex:
+    """
+    An in-memory inverted index of the whitespace separated words in each quote, for databases without FTS5.
+    A quote containing text of several words must have a word ending with the first of them, a word starting with
+    the last, and each word in between, so the quotes found from the rarest of those are then checked in full.
+    A single word may be anywhere inside a quote's words, so those are left to the database.
+    """
+
+    name = "words"
+
+    def __init__(self):
+        # lowercase word -> ids of the quotes containing it
+        self._postings = {}
+        # Every word, and every word reversed, sorted for prefix and suffix lookups
+        self._words = []
+        self._reversed_words = []
+        self._lock = Lock()
+
+    def _add(self, postings, quote_id, text):
+        new_words = []
+        for word in set(text.lower().split()):
+            ids = postings.get(word)
+            if ids is None:
+                ids = postings[word] = array('L')
+                new_words.append(word)
+
+            ids.append(quote_id)
+
+        return new_words
+
+    def load(self, db):
+        postings = {}
+        for quote_id, text in db.execute(sqlalchemy.select([quotes.id, quotes.quote]).order_by(quotes.id)):
+            self._add(postings, quote_id, text or '')
+
+        words = sorted(postings)
+        reversed_words = sorted(word[::-1] for word in words)
+        with self._lock:
+            self._postings = postings
+            self._words = words
+            self._reversed_words = reversed_words
+
+    def add(self, db, quote_id, text):
+        with self._lock:
+            for word in self._add(self._postings, quote_id, text):
+                insort(self._words, word)
+                insort(self._reversed_words, word[::-1])
+
+    @staticmethod
+    def _starting_with(words, prefix):
+        for i in range(bisect_left(words, prefix), len(words)):
+            if not words[i].startswith(prefix):
+                break
+
+            yield words[i]
+
+    def _find(self, term, position, last):
+        if position == 0:
+            words = (word[::-1] for word in self._starting_with(self._reversed_words, term[::-1]))
+        elif position == last:
+            words = self._starting_with(self._words, term)
+        else:
+            words = (term,) if term in self._postings else ()
+
+        ids = set()
+        for word in words:
+            ids.update(self._postings[word])
+
+        return ids
+
+    def search(self, db, text):
+        terms = text.lower().split()
+        if len(terms) < 2:
+            return None
+
+        with self._lock:
+            candidates = None
+            last = len(terms) - 1
+            for position, term in enumerate(terms):
+                ids = self._find(term, position, last)
+                if candidates is None or len(ids) < len(candidates):
+                    candidates = ids
+
+                if not candidates:
+                    return []
+
+        return match_quotes(db, text, sorted(candidates))
+
+
+active_quotes = ActiveQuotes()
+quote_index = WordIndex()
+
+
+@hook.on_start()
+def load_index(db):
+    """
+    :type db: sqlalchemy.orm.Session
+    """
+    global quote_index
+    index = None
+    if db.get_bind().dialect.name == 'sqlite':
+        index = FtsIndex()
+        try:
+            index.load(db)
+        except OperationalError:
+            db.rollback()
+            logger.info("SQLite FTS5 isn't available, indexing quotes in memory")
+            index = None
+
+    if index is None:
+        index = WordIndex()
+        index.load(db)
+
+    quote_index = index
+    active_quotes.load(db)
+
+
+def search_quotes(db, text):
+    """
+    Returns the ids of the quotes containing `text`, active or not
+
+    :rtype: list[int]
+    """
+    ids = quote_index.search(db, text)
+    if ids is None:
+        ids = match_quotes(db, text)
+
+    return ids
+
+
 def format_quote(q):
     """Returns a formatted string of a quote"""
     uts = time.strftime("%B %Y", time.localtime(q.time))
@@ -41,6 +371,10 @@ def quote(text, nick, message, db):
         db.commit()
     except IntegrityError:
         message("Message already stored, doing nothing.")
+        return
+
+    quote_index.add(db, quote.id, text)
+    active_quotes.add(quote.id)
     message("Quote added.")
 
 
@@ -49,16 +383,14 @@ def randomquote(text, message, db):
     """[text] - Gets a random quote."""
 
     if text:
-        data = db.query(quotes) \
-            .filter(quotes.active == True) \
-            .filter(quotes.quote.like(f"%{text}%")) \
-            .order_by(sqlalchemy.func.random()) \
-            .limit(1).first()
+        ids = [quote_id for quote_id in search_quotes(db, text) if quote_id in active_quotes]
+        quote_id = random.choice(ids) if ids else None
     else:
-        data = db.query(quotes) \
-            .filter(quotes.active == True) \
-            .order_by(sqlalchemy.func.random()) \
-            .limit(1).first()
+        quote_id = active_quotes.choice()
+
+    data = None
+    if quote_id is not None:
+        data = db.query(quotes).get(quote_id)
 
     if data:
         message(format_quote(data))
@@ -82,13 +414,11 @@ def getquote(text, message, db):
 @hook.command
 def searchquote(text, message, db):
     """<text> - Returns IDs for quotes matching <text>."""
-    data = db.query(quotes) \
-        .filter(quotes.quote.like(f"%{text}%")) \
-        .all()
+    ids = search_quotes(db, text)
 
-    if data:
+    if ids:
         message(formatting.truncate_str("Quotes: {}".format(
-            ', '.join([str(d.id) for d in data])), 350))
+            ', '.join(map(str, ids))), 350))
     else:
         return "None found."
 
@@ -104,6 +434,7 @@ def delquote(text, db):
     if data:
         data.active = False
         db.commit()
+        active_quotes.discard(data.id)
         return f"Quote #{text} deleted."
     else:
         return f"Quote #{text} was not found."
@@ -120,6 +451,7 @@ def restorequote(text, db):
     if data:
         data.active = True
         db.commit()
+        active_quotes.add(data.id)
         return f"Quote #{text} restored."
     else:
         return f"Quote #{text} was not found."
@@ -17,7 +17,7 @@ from datetime import datetime, timedelta
 from sqlalchemy import Table, Column, String, DateTime, PrimaryKeyConstraint
 
 from cloudbot import hook
-from cloudbot.util import database, colors
+from cloudbot.util import async_util, database, colors
 from cloudbot.util.timeformat import format_time, time_since
 from cloudbot.util.timeparse import time_parse
 
@@ -33,22 +33,52 @@ table = Table(
     PrimaryKeyConstraint('network', 'added_user', 'added_time')
 )
 
-reminder_cache = []
+# (network, user) -> {added_time: (remind_time, message)}
+reminder_cache = {}
 
+# Seconds to wait before trying again to deliver a reminder to a network which isn't connected
+RETRY_DELAY = 30
 
-async def delete_reminder(async_call, db, network, remind_time, user):
-    query = table.delete() \
-        .where(table.c.network == network.lower()) \
-        .where(table.c.remind_time == remind_time) \
-        .where(table.c.added_user == user.lower())
-    await async_call(db.execute, query)
-    await async_call(db.commit)
 
+def get_timer_key(network, user, added_time):
+    return 'remind', network, user, added_time
+
+
+def schedule_reminder(bot, network, user, added_time, remind_time, message):
+    """
+    Caches a reminder and arms a timer to deliver it
+
+    :type bot: cloudbot.bot.CloudBot
+    """
+    network, user = network.lower(), user.lower()
+    reminder_cache.setdefault((network, user), {})[added_time] = (remind_time, message)
+    bot.timers.schedule(
+        remind_time, send_reminder, bot, network, user, added_time, key=get_timer_key(network, user, added_time)
+    )
+
+
+def forget_reminders(bot, network, user, added_time=None):
+    """
+    Removes a user's reminders from the cache and cancels their timers, only the one added at `added_time` if given
+
+    :type bot: cloudbot.bot.CloudBot
+    """
+    network, user = network.lower(), user.lower()
+    reminders = reminder_cache.get((network, user), {})
+    for _added_time in list(reminders):
+        if added_time is None or _added_time == added_time:
+            del reminders[_added_time]
+            bot.timers.cancel_key(get_timer_key(network, user, _added_time))
+
+    if not reminders:
+        reminder_cache.pop((network, user), None)
 
-async def delete_all(async_call, db, network, user):
+
+async def delete_all(async_call, db, bot, network, user):
     query = table.delete() \
         .where(table.c.network == network.lower()) \
         .where(table.c.added_user == user.lower())
+    forget_reminders(bot, network, user)
     await async_call(db.execute, query)
     await async_call(db.commit)
 
@@ -67,14 +97,20 @@ async def add_reminder(async_call, db, network, added_user, added_chan, message,
 
 
 @hook.on_start()
-async def load_cache(async_call, db):
-    new_cache = []
-
-    for network, remind_time, added_time, user, message in (await async_call(_load_cache_db, db)):
-        new_cache.append((network, remind_time, added_time, user, message))
+async def load_cache(async_call, db, bot):
+    rows = await async_call(_load_cache_db, db)
 
+    cancel_reminders(bot)
     reminder_cache.clear()
-    reminder_cache.extend(new_cache)
+    for network, remind_time, added_time, user, message in rows:
+        schedule_reminder(bot, network, user, added_time, remind_time, message)
+
+
+@hook.on_stop()
+def cancel_reminders(bot):
+    for (network, user), reminders in list(reminder_cache.items()):
+        for added_time in reminders:
+            bot.timers.cancel_key(get_timer_key(network, user, added_time))
 
 
 def _load_cache_db(db):
@@ -82,51 +118,74 @@ def _load_cache_db(db):
     return [(row["network"], row["remind_time"], row["added_time"], row["added_user"], row["message"]) for row in query]
 
 
-@hook.periodic(30, initial_interval=30)
-async def check_reminders(bot, async_call, db):
-    current_time = datetime.now()
+async def send_reminder(bot, network, user, added_time):
+    """
+    :type bot: cloudbot.bot.CloudBot
+    """
+    reminder = reminder_cache.get((network, user), {}).get(added_time)
+    if reminder is None:
+        return
 
-    for reminder in reminder_cache:
-        network, remind_time, added_time, user, message = reminder
-        if remind_time <= current_time:
-            if network not in bot.connections:
-                # connection is invalid
-                continue
+    remind_time, message = reminder
+    conn = bot.connections.get(network)
+    if conn is None or not conn.ready:
+        # The reminder stays in the database and is scheduled again once the bot restarts, if this network returns
+        if conn is not None:
+            bot.timers.call_later(
+                RETRY_DELAY, send_reminder, bot, network, user, added_time,
+                key=get_timer_key(network, user, added_time)
+            )
 
-            conn = bot.connections[network]
+        return
+
+    current_time = datetime.now()
+    remind_text = colors.parse(time_since(added_time, count=2))
+    alert = colors.parse("{}, you have a reminder from $(b){}$(clear) ago!".format(user, remind_text))
 
-            if not conn.ready:
-                return
+    conn.message(user, alert)
+    conn.message(user, '"{}"'.format(message))
 
-            remind_text = colors.parse(time_since(added_time, count=2))
-            alert = colors.parse("{}, you have a reminder from $(b){}$(clear) ago!".format(user, remind_text))
+    delta = current_time - remind_time
+    if delta > timedelta(minutes=30):
+        late_time = time_since(remind_time, count=2)
+        late = "(I'm sorry for delivering this message $(b){}$(clear) late," \
+               " it seems I was unable to deliver it on time)".format(late_time)
+        conn.message(user, colors.parse(late))
 
-            conn.message(user, alert)
-            conn.message(user, '"{}"'.format(message))
+    forget_reminders(bot, network, user, added_time)
+    # The session is opened, used and closed in the one executor thread, as a sqlite connection can't change threads
+    await async_util.run_func(bot.loop, delete_reminder, bot, network, user, added_time)
 
-            delta = current_time - remind_time
-            if delta > timedelta(minutes=30):
-                late_time = time_since(remind_time, count=2)
-                late = "(I'm sorry for delivering this message $(b){}$(clear) late," \
-                       " it seems I was unable to deliver it on time)".format(late_time)
-                conn.message(user, colors.parse(late))
 
-            await delete_reminder(async_call, db, network, remind_time, user)
-            await load_cache(async_call, db)
+def delete_reminder(bot, network, user, added_time):
+    """
+    Deletes a delivered reminder, in a session of its own as it isn't run from a hook
+
+    :type bot: cloudbot.bot.CloudBot
+    """
+    query = table.delete() \
+        .where(table.c.network == network.lower()) \
+        .where(table.c.added_user == user.lower()) \
+        .where(table.c.added_time == added_time)
+    db = bot.db_session()
+    try:
+        db.execute(query)
+        db.commit()
+    finally:
+        db.close()
 
 
 @hook.command('remind', 'reminder', 'in')
-async def remind(text, nick, chan, db, conn, event, async_call):
+async def remind(text, nick, chan, db, conn, event, async_call, bot):
     """<1 minute, 30 seconds>: <do task> - reminds you to <do task> in <1 minute, 30 seconds>"""
 
-    count = len([x for x in reminder_cache if x[0] == conn.name and x[3] == nick.lower()])
+    count = len(reminder_cache.get((conn.name.lower(), nick.lower()), {}))
 
     if text == "clear":
         if count == 0:
             return "You have no reminders to delete."
 
-        await delete_all(async_call, db, conn.name, nick)
-        await load_cache(async_call, db)
+        await delete_all(async_call, db, bot, conn.name, nick)
         return "Deleted all ({}) reminders for {}!".format(count, nick)
 
     # split the input on the first ":"
@@ -164,7 +223,7 @@ async def remind(text, nick, chan, db, conn, event, async_call):
 
     # finally, add the reminder and send a confirmation message
     await add_reminder(async_call, db, conn.name, nick, chan, message, remind_time, current_time)
-    await load_cache(async_call, db)
+    schedule_reminder(bot, conn.name, nick, current_time, remind_time, message)
 
     remind_text = format_time(seconds, count=2)
     output = "Alright, I'll remind you \"{}\" in $(b){}$(clear)!".format(message, remind_text)
@@ -1,7 +1,8 @@
 import re
 import time
+from threading import Lock
 
-from sqlalchemy import Column, Float, PrimaryKeyConstraint, String, Table, and_, select
+from sqlalchemy import Column, Float, PrimaryKeyConstraint, String, Table, and_, bindparam, select
 
 from cloudbot import hook
 from cloudbot.event import EventType
@@ -18,41 +19,127 @@ table = Table(
     PrimaryKeyConstraint('name', 'chan')
 )
 
+# Seen data which hasn't been written to the database yet, {(name, chan): (time, quote, host)}
+pending = {}
+# The batch being written by flush(), so it can still be read until it is committed
+in_flight = {}
+pending_lock = Lock()
+# Makes sure batches are written in the order they were taken
+flush_lock = Lock()
 
-def track_seen(event, db):
+# Seconds between writes to the database
+FLUSH_INTERVAL = 10
+# Write straight away once this many entries are pending
+FLUSH_SIZE = 250
+
+update_query = table.update().where(and_(
+    table.c.name == bindparam('b_name'), table.c.chan == bindparam('b_chan')
+)).values(time=bindparam('b_time'), quote=bindparam('b_quote'), host=bindparam('b_host'))
+
+
+def track_seen(event):
     """ Tracks messages for the .seen command
     :type event: cloudbot.event.Event
-    :type db: sqlalchemy.orm.Session
+    :return: True if enough data is pending that it should be flushed
+    :rtype: bool
     """
     # keep private messages private
     now = time.time()
     if event.chan[:1] == "#" and not re.findall('^s/.*/.*/$', event.content.lower()):
-        res = db.execute(
-            table.update().where(and_(
-                table.c.name == event.nick.lower(), table.c.chan == event.chan
-            )).values(time=now, quote=event.content, host=str(event.mask))
-        )
-        if res.rowcount == 0:
-            db.execute(
-                table.insert().values(
-                    name=event.nick.lower(), time=now, quote=event.content,
-                    chan=event.chan, host=str(event.mask)
+        with pending_lock:
+            pending[(event.nick.lower(), event.chan)] = (now, event.content, str(event.mask))
+            return len(pending) >= FLUSH_SIZE
+
+    return False
+
+
+def flush(db):
+    """
+    Writes all pending seen data to the database in one transaction
+
+    :type db: sqlalchemy.orm.Session
+    """
+    with flush_lock:
+        with pending_lock:
+            if not pending:
+                return
+
+            batch = pending.copy()
+            pending.clear()
+            in_flight.update(batch)
+
+        rows = [
+            {'b_name': name, 'b_chan': chan, 'b_time': _time, 'b_quote': quote, 'b_host': host}
+            for (name, chan), (_time, quote, host) in batch.items()
+        ]
+
+        try:
+            existing = set(
+                tuple(row) for row in db.execute(
+                    select([table.c.name, table.c.chan]).where(table.c.name.in_({name for name, _ in batch}))
                 )
             )
 
-        db.commit()
+            updates = [row for row in rows if (row['b_name'], row['b_chan']) in existing]
+            inserts = [
+                {'name': row['b_name'], 'chan': row['b_chan'], 'time': row['b_time'], 'quote': row['b_quote'],
+                 'host': row['b_host']}
+                for row in rows if (row['b_name'], row['b_chan']) not in existing
+            ]
+
+            if updates:
+                db.execute(update_query, updates)
+
+            if inserts:
+                db.execute(table.insert(), inserts)
+
+            db.commit()
+        except Exception:
+            db.rollback()
+            with pending_lock:
+                # Put the batch back, unless there is newer data for the same user
+                for key, value in batch.items():
+                    pending.setdefault(key, value)
 
+                in_flight.clear()
 
-@hook.event([EventType.message, EventType.action], singlethread=True)
-def chat_tracker(event, db):
+            raise
+
+        with pending_lock:
+            in_flight.clear()
+
+
+@hook.event([EventType.message, EventType.action])
+def chat_tracker(event, bot):
     """
-    :type db: sqlalchemy.orm.Session
     :type event: cloudbot.event.Event
+    :type bot: cloudbot.bot.CloudBot
     """
     if event.type is EventType.action:
         event.content = "\x01ACTION {}\x01".format(event.content)
 
-    track_seen(event, db)
+    if track_seen(event):
+        db = bot.db_session()
+        try:
+            flush(db)
+        finally:
+            db.close()
+
+
+@hook.periodic(FLUSH_INTERVAL, initial_interval=FLUSH_INTERVAL)
+def flush_seen(db):
+    """
+    :type db: sqlalchemy.orm.Session
+    """
+    flush(db)
+
+
+@hook.on_stop
+def flush_seen_on_stop(db):
+    """
+    :type db: sqlalchemy.orm.Session
+    """
+    flush(db)
 
 
 @hook.command()
@@ -72,11 +159,17 @@ def seen(text, nick, chan, db, event, is_nick_valid):
     if not is_nick_valid(text):
         return "I can't look up that name, its impossible to use!"
 
-    last_seen = db.execute(
-        select([table.c.name, table.c.time, table.c.quote]).where(and_(
-            table.c.name == text.lower(), table.c.chan == chan
-        ))
-    ).fetchone()
+    with pending_lock:
+        buffered = pending.get((text.lower(), chan)) or in_flight.get((text.lower(), chan))
+
+    if buffered:
+        last_seen = (text.lower(),) + buffered[:2]
+    else:
+        last_seen = db.execute(
+            select([table.c.name, table.c.time, table.c.quote]).where(and_(
+                table.c.name == text.lower(), table.c.chan == chan
+            ))
+        ).fetchone()
 
     if last_seen:
         reltime = timeformat.time_since(last_seen[1])
@@ -1,17 +1,19 @@
-from collections import defaultdict
 from datetime import datetime
 from fnmatch import fnmatch
+from threading import Lock
 
 import sqlalchemy as sa
 from sqlalchemy import (
-    Boolean, Column, DateTime, PrimaryKeyConstraint, String, Table, and_, not_,
+    Boolean, Column, DateTime, Index, PrimaryKeyConstraint, String, Table, not_,
 )
 from sqlalchemy.sql import select
 
 from cloudbot import hook
 from cloudbot.event import EventType
 from cloudbot.util import timeformat, database, web
+from cloudbot.util.cached_table import CachedTable
 from cloudbot.util.formatting import gen_markdown_table
+from cloudbot.util.send_queue import PRIORITY_BULK
 
 table = Table(
     'tells',
@@ -22,7 +24,8 @@ table = Table(
     Column('message', String),
     Column('is_read', Boolean),
     Column('time_sent', DateTime),
-    Column('time_read', DateTime)
+    Column('time_read', DateTime),
+    Index('tells_unread_idx', 'connection', 'target', 'is_read'),
 )
 
 disable_table = Table(
@@ -45,9 +48,11 @@ ignore_table = Table(
     PrimaryKeyConstraint('conn', 'nick', 'mask'),
 )
 
-disable_cache = defaultdict(set)
-ignore_cache = defaultdict(lambda: defaultdict(list))
-tell_cache = []
+disable_cache = CachedTable(disable_table, ('conn', 'target'))
+ignore_cache = CachedTable(ignore_table, ('conn', 'nick', 'mask'))
+# Number of unread tells for each (connection, target), both lowercase
+tell_cache = {}
+tell_cache_lock = Lock()
 
 
 @hook.on_start
@@ -55,14 +60,32 @@ def load_cache(db):
     """
     :type db: sqlalchemy.orm.Session
     """
-    new_cache = []
-    for row in db.execute(table.select().where(not_(table.c.is_read))):
-        conn = row["connection"]
-        target = row["target"]
-        new_cache.append((conn, target))
+    query = select([table.c.connection, table.c.target, sa.func.count()]) \
+        .where(not_(table.c.is_read)) \
+        .group_by(table.c.connection, table.c.target)
+
+    new_cache = {(conn, target): count for conn, target, count in db.execute(query)}
+
+    with tell_cache_lock:
+        tell_cache.clear()
+        tell_cache.update(new_cache)
+
+
+def update_cache(server, target, change):
+    """
+    Adjusts the unread count for a target
 
-    tell_cache.clear()
-    tell_cache.extend(new_cache)
+    :type server: str
+    :type target: str
+    :type change: int
+    """
+    key = (server.lower(), target.lower())
+    with tell_cache_lock:
+        count = tell_cache.get(key, 0) + change
+        if count > 0:
+            tell_cache[key] = count
+        else:
+            tell_cache.pop(key, None)
 
 
 @hook.on_start
@@ -70,12 +93,7 @@ def load_disabled(db):
     """
     :type db: sqlalchemy.orm.Session
     """
-    new_cache = defaultdict(set)
-    for row in db.execute(disable_table.select()):
-        new_cache[row['conn']].add(row['target'].lower())
-
-    disable_cache.clear()
-    disable_cache.update(new_cache)
+    disable_cache.load(db)
 
 
 @hook.on_start
@@ -83,12 +101,7 @@ def load_ignores(db):
     """
     :type db: sqlalchemy.orm.Session
     """
-    new_cache = defaultdict(lambda: defaultdict(list))
-    for row in db.execute(ignore_table.select()):
-        new_cache[row['conn'].lower()][row['nick'].lower()].append(row['mask'])
-
-    ignore_cache.clear()
-    ignore_cache.update(new_cache)
+    ignore_cache.load(db)
 
 
 def is_disable(conn, target):
@@ -97,7 +110,7 @@ def is_disable(conn, target):
     :type target: str
     :rtype: bool
     """
-    return target.lower() in disable_cache[conn.name.lower()]
+    return (conn.name.lower(), target.lower()) in disable_cache
 
 
 def ignore_exists(conn, nick, mask):
@@ -107,7 +120,7 @@ def ignore_exists(conn, nick, mask):
     :type mask: str
     :rtype: bool
     """
-    return mask in ignore_cache[conn.name.lower()][nick.lower()]
+    return (conn.name.lower(), nick.lower(), mask.lower()) in ignore_cache
 
 
 def can_send_to_user(conn, sender, target):
@@ -117,10 +130,10 @@ def can_send_to_user(conn, sender, target):
     :type target: str
     :rtype: bool
     """
-    if target.lower() in disable_cache[conn.name.lower()]:
+    if (conn.name.lower(), target.lower()) in disable_cache:
         return False
 
-    for mask in ignore_cache[conn.name.lower()][target.lower()]:
+    for mask in list(ignore_cache.group(conn.name.lower(), target.lower())):
         if fnmatch(sender, mask):
             return False
 
@@ -138,9 +151,7 @@ def add_disable(db, conn, setter, target, now=None):
     if now is None:
         now = datetime.now()
 
-    db.execute(disable_table.insert().values(conn=conn.name.lower(), setter=setter, set_at=now, target=target.lower()))
-    db.commit()
-    load_disabled(db)
+    disable_cache.set(db, (conn.name.lower(), target.lower()), setter=setter, set_at=now)
 
 
 def del_disable(db, conn, target):
@@ -149,14 +160,7 @@ def del_disable(db, conn, target):
     :type conn: cloudbot.client.Client
     :type target: str
     """
-    db.execute(
-        disable_table.delete().where(and_(
-            disable_table.c.conn == conn.name.lower(),
-            disable_table.c.target == target.lower()
-        ))
-    )
-    db.commit()
-    load_disabled(db)
+    disable_cache.delete(db, (conn.name.lower(), target.lower()))
 
 
 def list_disabled(db, conn):
@@ -179,12 +183,7 @@ def add_ignore(db, conn, nick, mask, now=None):
     if now is None:
         now = datetime.now()
 
-    db.execute(ignore_table.insert().values(
-        conn=conn.name.lower(), set_at=now,
-        nick=nick.lower(), mask=mask.lower()
-    ))
-    db.commit()
-    load_ignores(db)
+    ignore_cache.set(db, (conn.name.lower(), nick.lower(), mask.lower()), set_at=now)
 
 
 def del_ignore(db, conn, nick, mask):
@@ -194,15 +193,7 @@ def del_ignore(db, conn, nick, mask):
     :type nick: str
     :type mask: str
     """
-    db.execute(
-        ignore_table.delete().where(and_(
-            ignore_table.c.conn == conn.name.lower(),
-            ignore_table.c.nick == nick.lower(),
-            ignore_table.c.mask == mask.lower(),
-        ))
-    )
-    db.commit()
-    load_ignores(db)
+    ignore_cache.delete(db, (conn.name.lower(), nick.lower(), mask.lower()))
 
 
 def list_ignores(conn, nick):
@@ -210,8 +201,7 @@ def list_ignores(conn, nick):
     :type conn: cloudbot.client.Client
     :type nick: str
     """
-    for mask in ignore_cache[conn.name.lower()][nick.lower()]:
-        yield mask
+    yield from list(ignore_cache.group(conn.name.lower(), nick.lower()))
 
 
 def get_unread(db, server, target):
@@ -245,7 +235,8 @@ def read_all_tells(db, server, target):
         .values(is_read=True)
     db.execute(query)
     db.commit()
-    load_cache(db)
+    with tell_cache_lock:
+        tell_cache.pop((server.lower(), target.lower()), None)
 
 
 def read_tell(db, server, target, message):
@@ -253,10 +244,11 @@ def read_tell(db, server, target, message):
         .where(table.c.connection == server.lower()) \
         .where(table.c.target == target.lower()) \
         .where(table.c.message == message) \
+        .where(not_(table.c.is_read)) \
         .values(is_read=True)
-    db.execute(query)
+    res = db.execute(query)
     db.commit()
-    load_cache(db)
+    update_cache(server, target, -res.rowcount)
 
 
 def add_tell(db, server, sender, target, message):
@@ -270,13 +262,11 @@ def add_tell(db, server, sender, target, message):
     )
     db.execute(query)
     db.commit()
-    load_cache(db)
+    update_cache(server, target, 1)
 
 
 def tell_check(conn, nick):
-    for _conn, _target in tell_cache:
-        if (conn, nick.lower()) == (_conn, _target):
-            return True
+    return (conn.lower(), nick.lower()) in tell_cache
 
 
 @hook.event([EventType.message, EventType.action], singlethread=True)
@@ -324,7 +314,7 @@ def showtells(nick, notice, db, conn):
     for tell in tells:
         sender, message, time_sent = tell
         past = timeformat.time_since(time_sent)
-        notice("{} sent you a message {} ago: {}".format(sender, past, message))
+        conn.notice(nick, "{} sent you a message {} ago: {}".format(sender, past, message), priority=PRIORITY_BULK)
 
     read_all_tells(db, conn.name, nick)
 